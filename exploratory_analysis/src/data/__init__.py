@@ -1,4 +1,7 @@
 # empty
 from .make_dataset import *
 from .jems_data import *
-from .build_ss_input import *
\ No newline at end of file
+from .pivot import *
+from .resample import *
+from .historian_cache import *
+from .build_ss_input import *
@@ -0,0 +1,68 @@
+"""
+A script for benchmarking concurrent loading of sensors (DieselDs.load_many)
+against serial loading (DieselDs.load per sensor) on a local SQLite stand-in
+of the historian database.
+
+Local queries do not have the network round trip of the MSSQL server, which
+can be emulated with the latency argument (seconds added to every query).
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import pandas as pd
+
+from src.data.jems_data import DieselDs, reshape_sensor_data
+from src.data.build_ss_input import COMPONENT_SENSORS
+from src.data.historian_standin import create_standin_db, fill_standin_values, connect_standin
+
+
+class LatencyConnection:
+    """DB-API connection wrapper which delays every cursor creation by latency seconds."""
+    def __init__(self, connection, latency):
+        self.connection = connection
+        self.latency = latency
+
+    def cursor(self):
+        time.sleep(self.latency)
+        return self.connection.cursor()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+if __name__ == "__main__":
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--component', default="B200-extended", help="Component whose sensors are loaded.")
+    parser.add_argument('-d', '--days', default=90, type=int, help="Number of days of hourly values per sensor.")
+    parser.add_argument('-w', '--workers', default=8, type=int, help="Number of concurrent connections.")
+    parser.add_argument('-lt', '--latency', default=0.05, type=float, help="Emulated latency of a query in seconds.")
+    args = parser.parse_args()
+
+    sensor_ids = [int(sensor) for sensor in COMPONENT_SENSORS[args.component]]
+    end_date = pd.Timestamp("2017-01-01") + pd.Timedelta(days=args.days)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "historian.sqlite")
+        connection = create_standin_db(path, sensor_ids)
+        fill_standin_values(connection, "2017-01-01", end_date, type="hour")
+        connection.close()
+
+        dt = DieselDs(connect=lambda: LatencyConnection(connect_standin(path), args.latency))
+
+        start = time.perf_counter()
+        serial = reshape_sensor_data(pd.concat([dt.load(sensor_id, "hour") for sensor_id in sensor_ids],
+                                               ignore_index=True))
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        wide = dt.load_many(sensor_ids, "hour", max_workers=args.workers)
+        concurrent_time = time.perf_counter() - start
+
+    assert wide.equals(serial)
+    print(f'Loaded {wide.shape[0]} timestamps of {wide.shape[1]} sensors')
+    print(f'Serial: {serial_time:.2f} s')
+    print(f'Concurrent ({args.workers} workers): {concurrent_time:.2f} s')
+    print(f'Speedup: {serial_time / concurrent_time:.1f}x')
@@ -2,10 +2,14 @@
 A script for building StreamStory input csv files for JEMS data.
 """
 
+import os
 import pandas as pd
 import argparse
 
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from src.data.resample import resample_sensor_values, FILL_METHODS
 
 # sensors per component
 COMPONENT_SENSORS = {
@@ -23,14 +27,124 @@ COMPONENT_SENSORS = {
                         '68','69','70','71','72','73','74','75','76','21','22','86','23','24','25','87','105','106','107'],
 }
 
+# format of timestamps in the sensor values csv
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# supported output formats
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+
 def normalize_timestamp(timestamp_series):
     """
     Convert timestamp to milliseconds.
     Assumes the series is sorted in ascending order!
     """
-    # convert datetime strings into milliseconds from epoch
-    times = pd.to_datetime(timestamp_series, format='%Y-%m-%d %H:%M:%S').astype(np.int64) // int(1e6)
-    return times
+    # convert datetime strings into milliseconds from epoch; the exact format
+    # takes the fast path of the parser and the explicit unit does not depend
+    # on the resolution pandas chooses
+    times = pd.to_datetime(timestamp_series, format=TIMESTAMP_FORMAT, cache=True)
+    return pd.Series(times.values.astype('datetime64[ms]').astype(np.int64),
+                     index=timestamp_series.index, name=timestamp_series.name)
+
+
+def sensor_renames(sensor_description_csv, sensor_ids):
+    """Return a mapping from sensor ids to sensor descriptions, usable as column names."""
+    sensor_description = pd.read_csv(open(sensor_description_csv), index_col='sensorid')
+    print(f'Read {sensor_description.shape[0]} rows and {sensor_description.shape[1]} columns')
+    return {col_id: sensor_description.loc[int(col_id)]['description'].replace(' ', '_')
+            for col_id in sensor_ids if int(col_id) in sensor_description.index}
+
+
+class ComponentWriter:
+    """Appends chunks of StreamStory input of one component to a csv or parquet file."""
+    def __init__(self, path, output_format='csv'):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}, got '{output_format}'")
+        self.path = path
+        self.output_format = output_format
+        self.file = None
+        self.rows = 0
+
+    def write(self, component_data):
+        if self.output_format == 'csv':
+            if self.file is None:
+                self.file = open(self.path, 'w', newline='')
+            component_data.to_csv(self.file, header=self.rows == 0)
+        else:
+            # pyarrow is only needed for the binary output
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # timestamp is stored as a regular column
+            table = pa.Table.from_pandas(component_data.reset_index(), preserve_index=False)
+            if self.file is None:
+                self.file = pq.ParquetWriter(self.path, table.schema)
+            self.file.write_table(table)
+        self.rows += len(component_data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def build_component_inputs(input_csv, outputs, col_rename=None, output_format='csv', chunk_size=None, jobs=None,
+                           grid_step=None, fill='linear', max_gap=None):
+    """
+    Build StreamStory input files of several components in a single pass over
+    the csv with sensor values in columns. The 'outputs' argument maps component
+    names from COMPONENT_SENSORS to output paths.
+    The csv is read in chunks of chunk_size rows (at once if None), so memory is
+    bounded by the chunk size. Only the needed columns are parsed, timestamps are
+    converted once per chunk, and the components of a chunk are written in
+    parallel while the next chunk is being read.
+    If grid_step (ms) is given, the values are resampled onto an even grid and
+    the gaps are filled with the 'fill' method, up to max_gap grid steps long
+    (see resample_sensor_values). The mask of values missing before the filling
+    is saved bit-packed next to each output as <output>.missing.npy. Resampling
+    needs the whole table, so it cannot be combined with chunk_size.
+    Returns the number of rows written for each component.
+    """
+    if grid_step is not None and chunk_size is not None:
+        raise ValueError("Resampling onto a grid needs the whole table, chunk_size must be None.")
+    # parse just the relevant sensor values and the timestamp
+    sensors = list(dict.fromkeys(sensor for component in outputs for sensor in COMPONENT_SENSORS[component]))
+    header = pd.read_csv(input_csv, nrows=0).columns
+    missing = [sensor for sensor in sensors if sensor not in header]
+    if missing:
+        print('Sensors missing in input:', ', '.join(missing))
+    reader = pd.read_csv(input_csv, usecols=lambda col: col == 'timestamp' or col in sensors,
+                         dtype={sensor: np.float64 for sensor in sensors}, chunksize=chunk_size)
+    if chunk_size is None:
+        reader = [reader]
+
+    writers = {component: ComponentWriter(path, output_format) for component, path in outputs.items()}
+    pending = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for chunk in reader:
+                chunk = chunk.set_index(normalize_timestamp(chunk['timestamp']).rename('timestamp'))
+                if grid_step is not None:
+                    chunk, missing = resample_sensor_values(chunk.drop(columns='timestamp'), grid_step, fill, max_gap)
+                # writes of the previous chunk must finish to keep the rows in order
+                for future in pending:
+                    future.result()
+                pending = []
+                for component, writer in writers.items():
+                    # collect the component's sensor values in the component's order
+                    component_data = chunk.filter(COMPONENT_SENSORS[component])
+                    if col_rename is not None:
+                        component_data = component_data.rename(columns=col_rename)
+                    pending.append(executor.submit(writer.write, component_data))
+                    if grid_step is not None:
+                        # missingness of the component's columns, in the same order
+                        columns = chunk.columns.get_indexer([sensor for sensor in COMPONENT_SENSORS[component]
+                                                             if sensor in chunk.columns])
+                        np.save(writer.path + '.missing.npy', missing[:, columns])
+            for future in pending:
+                future.result()
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return {component: writer.rows for component, writer in writers.items()}
 
 
 if __name__ == "__main__":
@@ -38,29 +152,34 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input-csv', help="Path to input csv with sensor values in columns.")
     parser.add_argument('-sd', '--sensor-description', default=None, help="[OPTIONAL] Path to input csv with sensor descriptions. If given, sensor descriptions will be used instead of IDs.")
-    parser.add_argument('-o', '--output-csv', help="Path to output csv with sensor data formatted for StreamStory.")
+    parser.add_argument('-o', '--output-csv', default=None, help="Path to output csv with sensor data formatted for StreamStory (single component).")
+    parser.add_argument('-c', '--components', nargs='+', default=["B100"], help="Components to build the input for, or 'all'.")
+    parser.add_argument('-od', '--output-dir', default=None, help="Directory for outputs of several components, named <component>_SS_input.<format>.")
+    parser.add_argument('-f', '--format', default='csv', choices=OUTPUT_FORMATS, help="Output format.")
+    parser.add_argument('-cs', '--chunk-size', default=None, type=int, help="[OPTIONAL] Number of rows processed at once, for inputs larger than memory.")
+    parser.add_argument('-j', '--jobs', default=None, type=int, help="[OPTIONAL] Number of parallel writers.")
+    parser.add_argument('-gs', '--grid-step', default=None, type=int, help="[OPTIONAL] Resample values onto an even grid with this step (ms) and fill the gaps.")
+    parser.add_argument('--fill', default='linear', choices=FILL_METHODS, help="Method for filling the gaps on the grid.")
+    parser.add_argument('--max-gap', default=None, type=int, help="[OPTIONAL] Longest gap (in grid steps) that is filled, longer gaps stay missing.")
     args = parser.parse_args()
 
-    print('Reading sensor values from', args.input_csv)
-    sensor_values = pd.read_csv(open(args.input_csv))
-    print(f'Read {sensor_values.shape[0]} rows and {sensor_values.shape[1]} columns')
+    components = list(COMPONENT_SENSORS) if args.components == ['all'] else args.components
+    if args.output_dir is not None:
+        outputs = {component: os.path.join(args.output_dir, f'{component}_SS_input.{args.format}')
+                   for component in components}
+    elif len(components) == 1 and args.output_csv is not None:
+        outputs = {components[0]: args.output_csv}
+    else:
+        raise RuntimeError("Output csv is needed for a single component, output dir for several.")
 
+    col_rename = None
     if args.sensor_description is not None:
         print('Reading sensor descriptions from', args.sensor_description)
-        sensor_description = pd.read_csv(open(args.sensor_description), index_col='sensorid')
-        print(f'Read {sensor_description.shape[0]} rows and {sensor_description.shape[1]} columns')
-
-        # go over all column ids except `timestamp` at 0 and prepare
-        col_rename = {}
-        for col_id in sensor_values.columns[1:]:
-            col_rename[col_id] = sensor_description.loc[int(col_id)]['description'].replace(' ', '_')
+        col_rename = sensor_renames(args.sensor_description,
+                                    {sensor for component in components for sensor in COMPONENT_SENSORS[component]})
 
-    target_component = "B100"
-    # collect just the relevant sensor values and the timestamp
-    component_data = sensor_values.filter(['timestamp'] + COMPONENT_SENSORS[target_component])
-    if args.sensor_description is not None:
-        component_data = component_data.rename(columns=col_rename)
-    component_data['timestamp'] = normalize_timestamp(component_data['timestamp'])
-    component_data = component_data.set_index('timestamp')
-
-    component_data.to_csv(args.output_csv)
\ No newline at end of file
+    print('Reading sensor values from', args.input_csv)
+    rows = build_component_inputs(args.input_csv, outputs, col_rename, args.format, args.chunk_size, args.jobs,
+                                  args.grid_step, args.fill, args.max_gap)
+    for component, path in outputs.items():
+        print(f'Wrote {rows[component]} rows of {component} to {path}')
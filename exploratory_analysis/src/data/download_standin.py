@@ -0,0 +1,76 @@
+"""
+A local HTTP stand-in for the Atena file server used by make_dataset. It serves
+files from memory and supports range requests, so downloads, resuming and
+skipping can be tested without network access. It is not part of the package
+namespace, import it explicitly:
+
+    from src.data.download_standin import start_download_standin
+
+    server, base_url = start_download_standin({"/data.zip": content})
+    download_url(base_url + "/data.zip", "data.zip")
+    server.shutdown()
+
+The server can also ignore range requests and break off responses after a
+number of bytes, to simulate simple servers and interrupted downloads.
+"""
+
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-$")
+
+
+class DownloadStandinHandler(BaseHTTPRequestHandler):
+    """Serves the files of the server, the first open-ended byte range of a request is honoured."""
+
+    def do_GET(self):
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.server.requests.append((self.path, self.headers.get("Range")))
+
+        match = RANGE_PATTERN.match(self.headers.get("Range", ""))
+        start = int(match.group(1)) if match and self.server.ranges else 0
+        if start >= len(content) and start > 0:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(len(content)))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206 if start > 0 else 200)
+        if start > 0:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(content) - 1, len(content)))
+        self.send_header("Accept-Ranges", "bytes" if self.server.ranges else "none")
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        body = content[start:]
+        if self.server.fail_after is not None:
+            # send only a part of the announced length and drop the connection
+            body = body[:self.server.fail_after]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_download_standin(files, host="127.0.0.1", port=0, ranges=True, fail_after=None):
+    """
+    Serve files (a dict mapping url paths like "/data.zip" to bytes) in a background
+    thread. If ranges is False, range requests are ignored and whole files are sent.
+    If fail_after is given, responses are broken off after that many bytes.
+    Returns the server and its base url. The server records (path, range header) of
+    each request in server.requests, and its files, ranges and fail_after attributes
+    can be changed while it runs. Stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), DownloadStandinHandler)
+    server.daemon_threads = True
+    server.files = dict(files)
+    server.ranges = ranges
+    server.fail_after = fail_after
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://{}:{}".format(*server.server_address)
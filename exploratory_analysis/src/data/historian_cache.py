@@ -0,0 +1,145 @@
+"""
+Local on-disk cache of the JEMS historian data, so that repeated analyses of the
+same time ranges do not go back to the MSSQL database and can also run offline.
+Parquet files are used, which requires pyarrow (or fastparquet).
+"""
+
+import os
+import json
+import pandas as pd
+
+ONE_DAY = pd.Timedelta(days=1)
+
+
+class HistorianCache:
+    """
+    Sensor values cached in columnar files partitioned by table type and day:
+        <root>/<type>/<YYYY-MM-DD>.parquet
+    A manifest per table type records when each partition was fetched.
+    Partitions fetched before their day was over (plus a grace period for late
+    values) are incomplete, and are fetched again on the next load together with
+    the missing ones. Complete partitions are always served from disk.
+    """
+    def __init__(self, root, grace=pd.Timedelta(hours=1), max_days_per_query=31):
+        """
+        Arguments:
+            root -- directory with the cached partitions.
+            grace -- time after the end of a day until its values are considered final.
+            max_days_per_query -- the longest range of days fetched with a single query.
+        """
+        self.root = root
+        self.grace = grace
+        self.max_days_per_query = max_days_per_query
+
+    def path(self, type, day):
+        """Path of the partition with values of the given type and day."""
+        return os.path.join(self.root, type, day.strftime('%Y-%m-%d') + '.parquet')
+
+    def manifest_path(self, type):
+        return os.path.join(self.root, type, 'manifest.json')
+
+    def manifest(self, type):
+        """Return a dictionary of fetch times of cached partitions by day."""
+        path = self.manifest_path(type)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return {day: pd.Timestamp(fetched) for day, fetched in json.load(f).items()}
+
+    def save_manifest(self, type, manifest):
+        path = self.manifest_path(type)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({day: fetched.isoformat() for day, fetched in manifest.items()}, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def stale_days(self, type, days):
+        """Return the days whose partitions are missing or incomplete."""
+        manifest = self.manifest(type)
+        stale = []
+        for day in days:
+            fetched = manifest.get(day.strftime('%Y-%m-%d'))
+            if fetched is None or fetched < day + ONE_DAY + self.grace or not os.path.exists(self.path(type, day)):
+                stale.append(day)
+        return stale
+
+    def query_runs(self, days):
+        """Group sorted days into runs of consecutive days, each fetched with one query."""
+        runs = []
+        for day in days:
+            if runs and day - runs[-1][-1] == ONE_DAY and len(runs[-1]) < self.max_days_per_query:
+                runs[-1].append(day)
+            else:
+                runs.append([day])
+        return runs
+
+    def refresh(self, fetch, days, type):
+        """
+        Fetch the values of consecutive days with fetch(start_date, end_date, type)
+        and store them as one partition per day.
+        """
+        os.makedirs(os.path.join(self.root, type), exist_ok=True)
+        fetched = pd.Timestamp.now()
+        values = fetch(days[0].strftime('%Y-%m-%d'), (days[-1] + ONE_DAY).strftime('%Y-%m-%d'), type)
+
+        day_keys = pd.to_datetime(values['timestamp']).dt.floor('D')
+        partitions = dict(list(values.groupby(day_keys)))
+        for day in days:
+            path = self.path(type, day)
+            partitions.get(day, values.iloc[:0]).to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+
+        manifest = self.manifest(type)
+        manifest.update({day.strftime('%Y-%m-%d'): fetched for day in days})
+        self.save_manifest(type, manifest)
+
+    def iter_range(self, fetch, start_date, end_date, type="raw", sensors=None, columns=None):
+        """
+        Yield sensor values between start_date and end_date as one dataframe per
+        day (schema as in DB), optionally limited to a list of integer sensor ids
+        and a list of columns. Missing and incomplete partitions are first fetched
+        with fetch(start_date, end_date, type) for all sensors, so they can serve
+        any later query. If fetch is None (offline), they raise a RuntimeError
+        instead.
+        """
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        days = pd.date_range(start.floor('D'), end, freq=ONE_DAY)
+        days = days[days < end]
+
+        stale = self.stale_days(type, days)
+        if stale and fetch is None:
+            raise RuntimeError(f"{len(stale)} days of '{type}' values between {start_date} and {end_date} "
+                               "are not cached.")
+        for run in self.query_runs(stale):
+            self.refresh(fetch, run, type)
+
+        # read only the needed columns of the columnar files
+        read_columns = None
+        if columns is not None:
+            read_columns = list(dict.fromkeys(list(columns) + ['timestamp', 'sensors_id']))
+
+        for day in days:
+            values = pd.read_parquet(self.path(type, day), columns=read_columns)
+            # partial days at the edges of the range
+            if day < start or day + ONE_DAY > end:
+                times = pd.to_datetime(values['timestamp'])
+                values = values[(start <= times) & (times < end)]
+            if sensors is not None:
+                values = values[values['sensors_id'].isin(sensors)]
+            if columns is not None:
+                values = values[list(columns)]
+            yield values.reset_index(drop=True)
+
+    def sensors_path(self):
+        return os.path.join(self.root, 'sensors.parquet')
+
+    def save_sensors(self, sdf):
+        """Store the sensor descriptions (DieselDs.sdf)."""
+        os.makedirs(self.root, exist_ok=True)
+        sdf.to_parquet(self.sensors_path() + '.tmp', index=False)
+        os.replace(self.sensors_path() + '.tmp', self.sensors_path())
+
+    def load_sensors(self):
+        """Return the stored sensor descriptions."""
+        if not os.path.exists(self.sensors_path()):
+            raise RuntimeError("Sensor descriptions are not cached.")
+        return pd.read_parquet(self.sensors_path())
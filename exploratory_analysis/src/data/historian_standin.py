@@ -0,0 +1,96 @@
+"""
+A local SQLite stand-in for the JEMS MSSQL historian database with the same
+schema as the tables used by DieselDs. Useful for testing and benchmarking the
+data retrieval without access to the real database. It is not part of the
+package namespace, import it explicitly:
+
+    from src.data.historian_standin import create_standin_db, fill_standin_values, connect_standin
+
+    connection = create_standin_db()
+    fill_standin_values(connection, "2017-01-01", "2017-02-01", type="hour")
+    dt = DieselDs(connect=connect_standin)
+
+By default the database lives in memory for as long as any connection to it is
+open. Pass a file path to keep it on disk.
+"""
+
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from .jems_data import TYPE_TABLES
+
+# pandas frequency of values in each type of table
+TYPE_FREQUENCIES = {
+    "raw" : pd.Timedelta("1min"),
+    "min" : pd.Timedelta("1min"),
+    "hour" : pd.Timedelta("1h"),
+    "day" : pd.Timedelta("1D"),
+}
+
+# in-memory database shared by all connections in the process
+MEMORY_DB = "file:historian?mode=memory&cache=shared"
+
+SCHEMA = """
+CREATE TABLE measure_unit_type (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE measure_unit (id INTEGER PRIMARY KEY, name TEXT, measure_unit_type_id INTEGER);
+CREATE TABLE datatype (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE sensor_groups (id INTEGER PRIMARY KEY, scan_rate INTEGER, description TEXT);
+CREATE TABLE sensors (id INTEGER PRIMARY KEY, name TEXT, description TEXT, enabled INTEGER,
+                      sensor_groups_id INTEGER, datatype_id INTEGER, measure_unit_id INTEGER);
+"""
+
+VALUES_SCHEMA = """
+CREATE TABLE {0} (id INTEGER PRIMARY KEY, sensors_id INTEGER, timestamp TEXT, value REAL);
+CREATE INDEX {0}_timestamp ON {0} (timestamp);
+CREATE INDEX {0}_sensors_id ON {0} (sensors_id, timestamp);
+"""
+
+
+def connect_standin(path=MEMORY_DB):
+    """Open a new connection to the stand-in database at path, usable from any thread."""
+    return sqlite3.connect(path, uri=path.startswith("file:"), check_same_thread=False)
+
+
+def create_standin_db(path=MEMORY_DB, sensor_ids=range(1, 130)):
+    """
+    Create the historian schema in a SQLite database at path and describe the
+    given sensors. Returns an open connection to the database.
+    """
+    connection = connect_standin(path)
+    connection.executescript(SCHEMA)
+    for table in TYPE_TABLES.values():
+        connection.executescript(VALUES_SCHEMA.format(table))
+
+    connection.execute("INSERT INTO measure_unit_type VALUES (1, 'generic')")
+    connection.execute("INSERT INTO measure_unit VALUES (1, 'unit', 1)")
+    connection.execute("INSERT INTO datatype VALUES (1, 'float')")
+    connection.execute("INSERT INTO sensor_groups VALUES (1, 1000, 'group')")
+    connection.executemany("INSERT INTO sensors VALUES (?, ?, ?, 1, 1, 1, 1)",
+                           [(int(i), f'S{i}', f'sensor {i}') for i in sensor_ids])
+    connection.commit()
+    return connection
+
+
+def fill_standin_values(connection, start_date, end_date, type="hour", sensor_ids=None, density=1.0, seed=0):
+    """
+    Insert random walk values of the given sensors (all described sensors by
+    default) between start_date and end_date into the table of the given
+    frequency type. Each value is kept with probability density, so sparse
+    sensors can be simulated.
+    """
+    if sensor_ids is None:
+        sensor_ids = [row[0] for row in connection.execute("SELECT id FROM sensors ORDER BY id")]
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start_date, end_date, freq=TYPE_FREQUENCIES[type])
+    times = times[times < pd.Timestamp(end_date)]
+    timestamps = times.strftime('%Y-%m-%d %H:%M:%S')
+
+    # one row per timestamp and sensor, ordered by timestamp
+    values = np.cumsum(rng.normal(size=(len(times), len(sensor_ids))), axis=0)
+    keep = rng.random(values.shape) < density
+    rows, cols = np.nonzero(keep)
+    connection.executemany(
+        "INSERT INTO {} (sensors_id, timestamp, value) VALUES (?, ?, ?)".format(TYPE_TABLES[type]),
+        zip((int(sensor_ids[c]) for c in cols), timestamps[rows], values[rows, cols].tolist()))
+    connection.commit()
@@ -2,14 +2,96 @@
 Utilities for retrieving and managing the JEMS data from the MSSQL database.
 """
 
+import time
+import queue
+import threading
 import pyodbc
 import pandas as pd
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .pivot import pivot_sensor_values
+from .build_ss_input import COMPONENT_SENSORS
+
+# tables with sensor values for each frequency type
+TYPE_TABLES = {
+    "raw" : "sensor_values",
+    "min" : "sensor_values_minute",
+    "hour" : "sensor_values_hour",
+    "day" : "sensor_values_day",
+}
+
+# columns needed to pivot sensor values
+VALUE_COLUMNS = ["timestamp", "sensors_id", "value"]
+
+class ConnectionPool:
+    """
+    A small pool of DB connections shared by worker threads. Connections are
+    opened lazily with the connect factory, up to size of them at once.
+    """
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool. A connection on which an error was
+        raised is closed and discarded, since it might be broken.
+        """
+        with self.lock:
+            open_new = self.idle.empty() and self.opened < self.size
+            if open_new:
+                self.opened += 1
+        if open_new:
+            try:
+                c = self.connect()
+            except Exception:
+                self.discard(None)
+                raise
+        else:
+            c = self.idle.get()
+
+        try:
+            yield c
+        except Exception:
+            self.discard(c)
+            raise
+        self.idle.put(c)
+
+    def discard(self, c):
+        """Close connection c (if any) and make room for a new one."""
+        with self.lock:
+            self.opened -= 1
+        if c is not None:
+            c.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while not self.idle.empty():
+            self.discard(self.idle.get())
+
 
 class DieselDs:
     """Class for retrieving the JEMS data from the database."""
-    def __init__(self, password):
-        self.c = self.connectToMSSQL(password)
+    def __init__(self, password=None, connect=None, cache=None, offline=False):
+        """
+        Connect to the MSSQL DB with the given password. Instead, a function
+        returning new DB-API connections to a database with the same schema (e.g.
+        connect_standin from historian_standin) can be given with 'connect'.
+        With a HistorianCache given as 'cache', range loads are served from local
+        files and only missing or incomplete days are fetched from the DB. In
+        offline mode no connection is opened and only cached data is available.
+        """
+        if offline and cache is None:
+            raise ValueError("Offline mode requires a cache.")
+        self.connect = connect if connect is not None else lambda: self.connectToMSSQL(password)
+        self.cache = cache
+        self.offline = offline
+        self.c = None if offline else self.connect()
         self.sensors()
 
     def connectToMSSQL(self, password):
@@ -20,7 +102,7 @@ class DieselDs:
                               "UID=SA;"
                               "PWD=" + password)
 
-    def load(self, sensorId, type="raw"):
+    def load(self, sensorId, type="raw", columns=None):
         """
         Retrieve values of sensor with sensorId from MSSQL.
         The 'type' argument determines the frequency type of the data:
@@ -28,48 +110,145 @@ class DieselDs:
             - min: minutely values
             - hour: hourly values
             - day: daily values
+        The 'columns' argument limits the retrieved columns (all by default).
         Return results in self.df pandas dataframe - schema as in DB.
         """
 
-        # selecting the correct table
-        typeTable = "sensor_values";
-        if (type == "min"):
-            typeTable = "sensor_values_minute"
-        elif (type == "hour"):
-            typeTable = "sensor_values_hour"
-        elif (type == "day"):
-            typeTable = "sensor_values_day"
-
         # retrieving the data
-        self.df = pd.read_sql_query('SELECT * FROM {} WHERE sensors_id = {} ORDER BY timestamp ASC'.format(typeTable, sensorId), self.c)
+        sql, params = self.valuesQuery(type, sensors=[sensorId], columns=columns)
+        self.df = pd.read_sql_query(sql, self.c, params=params)
 
         # also returning df
         return self.df
 
-    def load_range(self, start_date, end_date, type="raw"):
+    def load_range(self, start_date, end_date, type="raw", sensors=None, columns=None):
         """
         Retrieve sensor values of all sensors between start_date and end_date from MSSQL.
         The 'type' argument determines the frequency type of the data (details
         in docstring of load above).
+        The 'sensors' argument limits the retrieved sensors to a list of sensor
+        ids or to the sensors of a component from COMPONENT_SENSORS, and the
+        'columns' argument limits the retrieved columns. Both filters are part of
+        the query, so only the needed values are transferred.
         Return results in self.df pandas dataframe - schema as in DB.
         """
 
-        # selecting the correct table
-        typeTable = "sensor_values";
-        if (type == "min"):
-            typeTable = "sensor_values_minute"
-        elif (type == "hour"):
-            typeTable = "sensor_values_hour"
-        elif (type == "day"):
-            typeTable = "sensor_values_day"
-
         # retrieving the data
-        self.df = pd.read_sql_query("SELECT * FROM {} WHERE '{}' <= timestamp AND timestamp < '{}'\
-                                    ORDER BY timestamp ASC".format(typeTable, start_date, end_date), self.c)
+        if self.cache is not None:
+            self.df = pd.concat(list(self.load_range_chunks(start_date, end_date, type, sensors=sensors,
+                                                            columns=columns)), ignore_index=True)
+        else:
+            self.df = self.fetchRange(start_date, end_date, type, sensors=sensors, columns=columns)
 
         # also returning df
         return self.df
 
+    def load_range_chunks(self, start_date, end_date, type="raw", chunksize=100000, sensors=None, columns=None):
+        """
+        Stream sensor values of all sensors between start_date and end_date from
+        MSSQL as a generator of dataframes with at most chunksize rows each
+        (schema as in DB, ordered by timestamp). Sensors and columns can be
+        limited as in load_range.
+        Rows are fetched from an open forward-only cursor, so the first chunk is
+        available before the whole query result has arrived and memory is bounded
+        by the chunk size. The connection is busy until the generator is exhausted
+        or closed.
+        With a cache, chunks are the cached partitions of individual days instead.
+        """
+        if self.cache is not None:
+            fetch = None if self.offline else self.fetchRange
+            yield from self.cache.iter_range(fetch, start_date, end_date, type, sensors=self.sensorIds(sensors),
+                                             columns=columns)
+        else:
+            sql, params = self.valuesQuery(type, start_date, end_date, sensors, columns)
+            yield from pd.read_sql_query(sql, self.c, params=params, chunksize=chunksize)
+
+    def fetchRange(self, start_date, end_date, type="raw", sensors=None, columns=None):
+        """Query sensor values between start_date and end_date, bypassing the cache."""
+        sql, params = self.valuesQuery(type, start_date, end_date, sensors, columns)
+        return pd.read_sql_query(sql, self.c, params=params)
+
+    def load_many(self, sensor_ids, type="raw", start_date=None, end_date=None, max_workers=4, retries=3):
+        """
+        Retrieve values of several sensors (list of ids or a component name)
+        concurrently, one query per sensor, optionally limited to the time range
+        between start_date and end_date.
+        At most max_workers queries run at once, each over its own connection
+        from a pool. A failed query is retried up to 'retries' times on a fresh
+        connection with exponential backoff.
+        Returns a dataframe with one row per timestamp and one column per sensor.
+        """
+        pool = ConnectionPool(self.connect, max_workers)
+
+        def load_sensor(sensorId):
+            """Query one sensor, retrying on errors."""
+            sql, params = self.valuesQuery(type, start_date, end_date, [sensorId], VALUE_COLUMNS)
+            for attempt in range(retries + 1):
+                try:
+                    with pool.connection() as c:
+                        return pd.read_sql_query(sql, c, params=params)
+                except Exception:
+                    if attempt == retries:
+                        raise
+                    time.sleep(0.1 * 2 ** attempt)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                values = list(executor.map(load_sensor, self.sensorIds(sensor_ids)))
+        finally:
+            pool.close()
+
+        # pivot all sensors at once into the wide layout
+        return pivot_sensor_values(pd.concat(values, ignore_index=True))
+
+    def typeTable(self, type):
+        """Return the name of the table with values of the given frequency type."""
+        return TYPE_TABLES.get(type, TYPE_TABLES["raw"])
+
+    def sensorIds(self, sensors):
+        """
+        Return a list of integer sensor ids for a list of sensor ids or the name
+        of a component from COMPONENT_SENSORS. None stands for all sensors.
+        """
+        if sensors is None:
+            return None
+        if isinstance(sensors, str):
+            if sensors not in COMPONENT_SENSORS:
+                raise ValueError(f"Unknown component '{sensors}'.")
+            sensors = COMPONENT_SENSORS[sensors]
+        return [int(sensor) for sensor in sensors]
+
+    def valuesQuery(self, type, start_date=None, end_date=None, sensors=None, columns=None):
+        """
+        Return the parameterized query and its parameters for sensor values of
+        the given type, ordered by timestamp. Time bounds, sensors (see
+        sensorIds) and a column projection are optional.
+        """
+        if columns is None:
+            projection = '*'
+        else:
+            for column in columns:
+                if not column.isidentifier():
+                    raise ValueError(f"Invalid column name '{column}'.")
+            projection = ', '.join(columns)
+
+        conditions, params = [], []
+        if start_date is not None:
+            conditions.append('? <= timestamp')
+            params.append(start_date)
+        if end_date is not None:
+            conditions.append('timestamp < ?')
+            params.append(end_date)
+        sensors = self.sensorIds(sensors)
+        if sensors is not None:
+            conditions.append('sensors_id IN ({})'.format(', '.join('?' * len(sensors))))
+            params.extend(sensors)
+
+        sql = 'SELECT {} FROM {}'.format(projection, self.typeTable(type))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return sql + ' ORDER BY timestamp ASC', params
+
     def sensors(self):
         """
         retrieving the data from sensors
@@ -98,7 +277,13 @@ class DieselDs:
             measure_unit_id = measure_unit.id AND \
             measure_unit_type_id = measure_unit_type.id"
 
+        if self.offline:
+            self.sdf = self.cache.load_sensors()
+            return
+
         self.sdf = pd.read_sql_query(SQL, self.c)
+        if self.cache is not None:
+            self.cache.save_sensors(self.sdf)
 
     def searchSensor(self, id):
         """
@@ -107,19 +292,10 @@ class DieselDs:
         return self.sdf[self.sdf['name'].str.contains(id) == True]
 
 
-def reshape_sensor_data(input_df):
+def reshape_sensor_data(input_df, duplicates="last", representation="dense"):
     """
     Reshape a dataframe with sensor values in schema as in the DB into a data
     frame with one row per timestamp and one column per sensor.
+    Pivoting is vectorized, see pivot_sensor_values for the arguments.
     """
-    def sensor_value_to_table(sensor_row, table):
-        """Write a sensor value to the reshaped table."""
-        table.at[sensor_row['timestamp'], sensor_row['sensors_id']] = sensor_row['value']
-
-    # prepare the reshaped table
-    output_df = pd.DataFrame(
-        index = np.sort(input_df["timestamp"].unique()),
-        columns = np.sort(input_df["sensors_id"].unique()))
-    # copy individual sensor values
-    input_df.apply(lambda row: sensor_value_to_table(row, output_df), axis=1)
-    return output_df
+    return pivot_sensor_values(input_df, duplicates=duplicates, representation=representation)
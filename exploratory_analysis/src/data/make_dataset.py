@@ -16,27 +16,97 @@ raw_targets = [
     '../../../data/raw/continental',
 ]
 
-import requests, zipfile, io, sys
-def download_url(url, save_path, chunk_size=4096 * 1024):
-    print("Starting download", url)
-    r = requests.get(url, stream=True)
-    with open(save_path, 'wb') as fd:
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            fd.write(chunk)
-    print(" Finished.\n")
+# SHA-256 checksums of the files, None where it is not known
+checksums = [
+    None,
+    None,
+]
+
+import requests, zipfile, os, hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def file_checksum(path, chunk_size=4096 * 1024):
+    """Return the SHA-256 checksum of a file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def download_url(url, save_path, chunk_size=4096 * 1024, checksum=None):
+    """
+    Download url to save_path and return True, or False if the download was skipped.
+    The download is skipped when save_path already exists and its checksum matches
+    the given SHA-256 checksum, or the one recorded in save_path.sha256 by an
+    earlier download. Data is written to save_path.part first, and an interrupted
+    download is resumed from there with an HTTP range request.
+    """
+    checksum_path = save_path + '.sha256'
+    expected = checksum
+    if expected is None and os.path.exists(checksum_path):
+        with open(checksum_path) as fd:
+            expected = fd.read().strip()
+    if expected is not None and os.path.exists(save_path) and file_checksum(save_path, chunk_size) == expected:
+        print("Already downloaded", url)
+        return False
+
+    part_path = save_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+    print("Starting download", url, "from byte {}".format(offset) if offset > 0 else "")
+    with requests.get(url, stream=True, headers=headers, timeout=60) as r:
+        # 416 means the partial file already holds the whole content
+        if r.status_code != 416:
+            r.raise_for_status()
+            # the server ignored the range, so start over
+            if r.status_code != 206:
+                offset = 0
+            with open(part_path, 'ab' if offset > 0 else 'wb') as fd:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    fd.write(chunk)
+
+    digest = file_checksum(part_path, chunk_size)
+    if checksum is not None and digest != checksum:
+        os.remove(part_path)
+        raise RuntimeError("Checksum of {} does not match, download removed.".format(url))
+    os.replace(part_path, save_path)
+    with open(checksum_path, 'w') as fd:
+        fd.write(digest)
+    print("Finished", url)
+    return True
+
+
+def extract_zip(zip_path, raw_target):
+    """Unzip an archive into the raw_target folder."""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        print("Starting to unzip into", raw_target)
+        zip_ref.extractall(raw_target)
+
+
+def download_and_extract(files, targets, raw_targets, max_workers=4, checksums=None):
+    """
+    Download files to targets concurrently and unzip each archive into its raw
+    target as soon as it is downloaded, while the other downloads continue.
+    The optional checksums list holds the expected SHA-256 checksum of each file
+    (or None), see download_url. Archives that did not change are not extracted
+    again if their raw target already exists.
+    """
+    checksums = checksums if checksums is not None else [None] * len(targets)
+    with ThreadPoolExecutor(max_workers=max_workers) as downloads, ThreadPoolExecutor(max_workers=1) as extractions:
+        futures = {downloads.submit(download_url, files[i], targets[i], checksum=checksums[i]): i
+                   for i in range(len(targets))}
+        extracted = []
+        for future in as_completed(futures):
+            i = futures[future]
+            if future.result() or not os.path.exists(raw_targets[i]):
+                extracted.append(extractions.submit(extract_zip, targets[i], raw_targets[i]))
+        for future in extracted:
+            future.result()
 
 
 if __name__ == "__main__":
-    # download files
-    print("### DOWNLOADING TO INTERIM FOLDER ###")
-    for i in range(len(targets)):
-        download_url(files[i], targets[i])
-
-    # unzipping
-    print("### UNZIPPING TO RAW FOLDER ###")
-    for i in range(len(targets)):
-        with zipfile.ZipFile(targets[i], 'r') as zip_ref:
-            print("Starting to unzip into", raw_targets[i])
-            zip_ref.extractall(raw_targets[i])
\ No newline at end of file
+    # download files into the interim folder and unzip them into the raw folder
+    print("### DOWNLOADING TO INTERIM AND UNZIPPING TO RAW FOLDER ###")
+    download_and_extract(files, targets, raw_targets, checksums=checksums)
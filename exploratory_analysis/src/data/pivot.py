@@ -0,0 +1,116 @@
+"""
+Vectorized pivoting of long sensor values (schema as in the DB: timestamp,
+sensors_id, value) into a wide table with one row per timestamp and one column
+per sensor.
+"""
+
+import numpy as np
+import pandas as pd
+
+# supported policies for multiple values of the same sensor at the same timestamp
+DUPLICATE_POLICIES = ("last", "first", "mean")
+# supported output representations
+REPRESENTATIONS = ("dense", "sparse", "masked")
+
+
+def reduce_duplicates(keys, values, duplicates):
+    """
+    Reduce values sharing the same cell key according to the duplicate policy.
+    Returns sorted unique keys and one value per key.
+    """
+    if duplicates == "last":
+        # first occurrence in the reversed order is the last one in the original
+        unique_keys, index = np.unique(keys[::-1], return_index=True)
+        return unique_keys, values[::-1][index]
+    if duplicates == "first":
+        unique_keys, index = np.unique(keys, return_index=True)
+        return unique_keys, values[index]
+    if duplicates == "mean":
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        valid = ~np.isnan(values)
+        sums = np.bincount(inverse[valid], weights=values[valid], minlength=len(unique_keys))
+        counts = np.bincount(inverse[valid], minlength=len(unique_keys))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return unique_keys, sums / counts
+    raise ValueError(f"duplicates must be one of {DUPLICATE_POLICIES}, got '{duplicates}'")
+
+
+def pivot_sensor_values(input_df, duplicates="last", representation="dense", dtype=np.float32,
+                        index_col="timestamp", columns_col="sensors_id", values_col="value"):
+    """
+    Pivot a long dataframe with sensor values into a wide table in one vectorized
+    step. Timestamps and sensor ids are factorized into sorted integer codes and
+    the values are scattered into a preallocated matrix.
+
+    The 'duplicates' argument determines which value is kept when a sensor has
+    several values at the same timestamp:
+        - last: the last value in the input order (same as the row-wise reshape)
+        - first: the first value in the input order
+        - mean: the mean of the non-missing values
+    The 'representation' argument determines the output:
+        - dense: DataFrame of `dtype` with NaN for missing values
+        - sparse: DataFrame with sparse columns (NaN fill value), the dense
+          matrix is never allocated, which is useful for very sparse sensors
+        - masked: tuple (numpy masked array, index, columns)
+    """
+    if representation not in REPRESENTATIONS:
+        raise ValueError(f"representation must be one of {REPRESENTATIONS}, got '{representation}'")
+
+    # integer codes of rows and columns (labels are sorted ascending)
+    row_codes, row_labels = pd.factorize(input_df[index_col], sort=True)
+    col_codes, col_labels = pd.factorize(input_df[columns_col], sort=True)
+    n_rows, n_cols = len(row_labels), len(col_labels)
+
+    # flat cell key of every value, reduced to one value per cell
+    keys = row_codes.astype(np.int64) * n_cols + col_codes
+    values = np.asarray(input_df[values_col], dtype=np.float64)
+    keys, values = reduce_duplicates(keys, values, duplicates)
+
+    index = pd.Index(row_labels, name=index_col)
+    columns = pd.Index(col_labels)
+
+    if representation == "sparse":
+        # keys are sorted by row, sort them by column to split them per sensor
+        rows, cols = np.divmod(keys, n_cols)
+        order = np.argsort(cols, kind="stable")
+        bounds = np.searchsorted(cols[order], np.arange(n_cols + 1))
+        data = {}
+        for j, col in enumerate(columns):
+            cell = order[bounds[j]:bounds[j + 1]]
+            column = np.full(n_rows, np.nan, dtype=dtype)
+            column[rows[cell]] = values[cell]
+            data[col] = pd.arrays.SparseArray(column, fill_value=np.nan)
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    # preallocate the matrix and scatter the values into it
+    matrix = np.full(n_rows * n_cols, np.nan, dtype=dtype)
+    matrix[keys] = values
+    matrix = matrix.reshape(n_rows, n_cols)
+
+    if representation == "masked":
+        return np.ma.masked_invalid(matrix, copy=False), index, columns
+    return pd.DataFrame(matrix, index=index, columns=columns)
+
+
+def pivot_sensor_chunks(chunks, index_col="timestamp", **kwargs):
+    """
+    Pivot a stream of long dataframes ordered by timestamp (e.g. from
+    DieselDs.load_range_chunks) into a stream of wide tables, as the chunks
+    arrive. Rows of the last timestamp in a chunk are held back until the next
+    chunk, so a timestamp split between two chunks ends up in a single row.
+    Remaining keyword arguments are passed to pivot_sensor_values.
+    """
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        if chunk.empty:
+            continue
+        last = chunk[index_col].iloc[-1]
+        complete = (chunk[index_col] != last).to_numpy()
+        pending = chunk[~complete]
+        if complete.any():
+            yield pivot_sensor_values(chunk[complete], index_col=index_col, **kwargs)
+    if pending is not None and not pending.empty:
+        yield pivot_sensor_values(pending, index_col=index_col, **kwargs)
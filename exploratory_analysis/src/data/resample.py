@@ -0,0 +1,121 @@
+"""
+Resampling of sensor values with millisecond timestamps (see normalize_timestamp)
+onto an evenly timed grid and imputation of the gaps, as expected by the
+TransitionModel of StreamStoryPy. Everything is vectorized with NumPy, and
+the gap filling only touches the missing cells.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .pivot import reduce_duplicates
+
+# supported gap filling methods
+FILL_METHODS = ("ffill", "linear")
+
+
+def snap_to_grid(times, values, step, start=None, dtype=np.float64):
+    """
+    Snap sorted millisecond timestamps onto an even grid of the given step (ms)
+    starting at start (the first timestamp by default). Each sample moves to the
+    nearest grid point, and when several samples of a sensor meet at one grid
+    point, the last non-missing one is kept.
+    Returns grid timestamps and a matrix of shape (n_grid, n_sensors) and the
+    given dtype with NaN at grid points without values.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, values.shape[1]), dtype=dtype)
+    start = times[0] if start is None else start
+    grid_index = np.rint((times - start) / step).astype(np.int64)
+    n_grid, n_cols = grid_index[-1] + 1, values.shape[1]
+    grid = np.full((n_grid, n_cols), np.nan, dtype=dtype)
+
+    if np.all(np.diff(grid_index) > 0):
+        # fast path: at most one sample per grid point
+        grid[grid_index] = values
+    else:
+        rows, cols = np.nonzero(~np.isnan(values))
+        keys, cell_values = reduce_duplicates(grid_index[rows] * n_cols + cols, values[rows, cols], "last")
+        grid.reshape(-1)[keys] = cell_values
+    return start + np.arange(n_grid, dtype=np.int64) * step, grid
+
+
+def fill_gaps(matrix, method="linear", max_gap=None):
+    """
+    Fill the missing values (NaN) in the columns of the matrix in place.
+    The 'method' argument determines the filling:
+        - ffill: repeat the last observed value
+        - linear: interpolate linearly between the observed values around the
+          gap, gaps after the last observed value are forward filled
+    Gaps longer than max_gap rows are left unfilled, as are the values before the
+    first observed value of a column. Returns the matrix, which can have any
+    memory layout (e.g. the F-contiguous result of DataFrame.to_numpy).
+    The work is proportional to the number of missing cells: the missing cells
+    are listed column by column, split into runs (gaps), and each run is filled
+    from the observed values just before and after it.
+    """
+    if method not in FILL_METHODS:
+        raise ValueError(f"method must be one of {FILL_METHODS}, got '{method}'")
+    n_rows, n_cols = matrix.shape
+
+    # missing cells in column-major order, so the cells of a gap are consecutive
+    gaps = np.flatnonzero(np.isnan(matrix).T)
+    if len(gaps) == 0:
+        return matrix
+    cols, rows = np.divmod(gaps, n_rows)
+
+    # first and last cell of every gap
+    starts = np.ones(len(gaps), dtype=bool)
+    starts[1:] = gaps[1:] != gaps[:-1] + 1
+    starts |= rows == 0
+    ends = np.ones(len(gaps), dtype=bool)
+    ends[:-1] = starts[1:]
+    gap_id = np.cumsum(starts) - 1
+    # rows of the observed values around the gap of each cell
+    previous = rows[starts][gap_id] - 1
+    following = rows[ends][gap_id] + 1
+
+    # values before the first observed value stay missing
+    fill = previous >= 0
+    if max_gap is not None:
+        fill &= (following - previous - 1) <= max_gap
+    if not fill.all():
+        rows, cols, previous, following = rows[fill], cols[fill], previous[fill], following[fill]
+
+    # two-dimensional indexing writes into the matrix whatever its memory layout
+    filled = matrix[previous, cols]
+    if method == "linear":
+        after = matrix[np.minimum(following, n_rows - 1), cols]
+        weight = (rows - previous) / (following - previous)
+        filled = np.where(following < n_rows, filled + (after - filled) * weight, filled)
+    matrix[rows, cols] = filled
+    return matrix
+
+
+def pack_mask(mask):
+    """Pack a boolean matrix of shape (n_rows, n_cols) into bits along the rows (8x smaller)."""
+    return np.packbits(mask, axis=0)
+
+
+def unpack_mask(packed, n_rows):
+    """Unpack a matrix packed with pack_mask into a boolean matrix with n_rows rows."""
+    return np.unpackbits(packed, axis=0, count=n_rows).astype(bool)
+
+
+def resample_sensor_values(data, step, method="linear", max_gap=None, dtype=None):
+    """
+    Resample a dataframe with millisecond timestamps as index (sorted) and one
+    column per sensor onto an even grid with the given step (ms) and fill the
+    gaps (see fill_gaps). Values keep the floating point precision of the
+    data (float64 for integer columns) unless a dtype is given.
+    Returns the resampled dataframe and the bit-packed mask of values missing
+    on the grid before the filling (see pack_mask).
+    """
+    if dtype is None:
+        dtype = np.float32 if all(column_dtype == np.float32 for column_dtype in data.dtypes) else np.float64
+    times, grid = snap_to_grid(data.index.to_numpy(), data.to_numpy(dtype=np.float64), step, dtype=dtype)
+    missing = pack_mask(np.isnan(grid))
+    fill_gaps(grid, method=method, max_gap=max_gap)
+    return pd.DataFrame(grid, index=pd.Index(times, name=data.index.name), columns=data.columns), missing
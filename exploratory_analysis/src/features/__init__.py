@@ -1,3 +1,4 @@
 # holder
+from .streaming_stats import *
 from .analyse_range import *
 from .pca_on_range import *
\ No newline at end of file
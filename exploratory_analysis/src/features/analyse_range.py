@@ -1,8 +1,15 @@
 """
 A script for performing analyses on a time range of JEMS sensor data.
+
+Usage: python analyse_range.py <command> [options], with commands
+    load -- load a time range from the DB and save sensor values in columns
+    describe -- join statistics of sensor values with sensor descriptions
+    prepare -- format sensor values as StreamStory input
+Run a command with -h for its options.
 """
 
 import os
+import sys
 import pyodbc
 import pdb
 import argparse
@@ -12,7 +19,8 @@ from sklearn.impute import SimpleImputer
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from dotenv import load_dotenv
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.cluster import KMeans
 
 # get settings from .env file
@@ -21,10 +29,11 @@ if os.path.exists("../.env"):
 else:
     raise RuntimeError("Expecting .env file with settings.")
 
-from src.data import jems_data
+from src.data import jems_data, historian_cache
+from src.features.streaming_stats import SensorStatistics
 # import src.data.stateGraph
 
-def load_DB_and_reshape():
+def load_DB_and_reshape(argv=None):
     # read arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--start-date', default="2017-01-21", help="Start of interval to analyse. \
@@ -32,38 +41,76 @@ def load_DB_and_reshape():
     parser.add_argument('-e', '--end-date', default="2017-01-22", help="End of interval to analyse. \
                         Date must be given as 'YYYY-MM-DD hh:mm:ss' or as any prefix of it.", metavar='E')
     parser.add_argument('-l', '--save-location', default="results/", help="Location for saving results", metavar='L')
-    args = parser.parse_args()
+    parser.add_argument('-cl', '--cache-location', default=None, help="[OPTIONAL] Location of the local cache of DB values.", metavar='C')
+    parser.add_argument('--offline', action='store_true', help="Use only values from the cache, without connecting to the DB.")
+    parser.add_argument('-c', '--component', default=None, help="[OPTIONAL] Load only sensors of this component (see COMPONENT_SENSORS).")
+    parser.add_argument('-cs', '--chunk-size', default=100000, type=int, help="Number of DB rows fetched and reshaped at once.")
+    args = parser.parse_args(argv)
 
     # check if save location is a valid path
     if not os.path.exists(args.save_location):
         raise RuntimeError("Save location must be a valid path.")
 
     # initialize Diesel data source
-    dt = jems_data.DieselDs(os.getenv("DB_PASSWORD"))
-
-    # get sensor values for each hour between start and end date
-    print(f'Loading data in time range: {args.start_date} - {args.end_date}')
-    values = dt.load_range(args.start_date, args.end_date, "hour")
+    cache = historian_cache.HistorianCache(args.cache_location) if args.cache_location is not None else None
+    dt = jems_data.DieselDs(os.getenv("DB_PASSWORD"), cache=cache, offline=args.offline)
 
-    print(f'Loaded')
+    # get sensor values for each hour between start and end date and reshape
+    # them chunk by chunk as they arrive, so that each column represents one sensor
+    print(f'Loading and reshaping data in time range: {args.start_date} - {args.end_date}')
+    chunks = dt.load_range_chunks(args.start_date, args.end_date, "hour", chunksize=args.chunk_size,
+                                  sensors=args.component, columns=jems_data.VALUE_COLUMNS)
+    sensor_values = pd.concat(jems_data.pivot_sensor_chunks(chunks), sort=True)
 
-    # create dataframe where each column represents one sensor
-    print('Reshaping data')
-    sensor_values = jems_data.reshape_sensor_data(values)
+    print(f'Loaded {sensor_values.shape[0]} timestamps of {sensor_values.shape[1]} sensors')
     sensor_values.to_csv(os.path.join(args.save_location, 'sensor_values.csv'))
 
 
-def join_sensor_descriptions():
+def chunk_statistics(chunk, relative_accuracy=0.01):
+    """Statistics of the sensor values in a chunk of the csv (see SensorStatistics)."""
+    return SensorStatistics(relative_accuracy).update(chunk.drop(columns='timestamp', errors='ignore'))
+
+
+def describe_csv(input_csv, chunk_size=100000, jobs=None, relative_accuracy=0.01):
+    """
+    Statistics of the csv with sensor values in columns, computed in one pass
+    over chunks of chunk_size rows, so the csv does not need to fit in memory.
+    With jobs > 1 the chunks are summarized by a pool of worker processes and the
+    partial results are merged in the order of the chunks.
+    """
+    statistics = SensorStatistics(relative_accuracy)
+    reader = pd.read_csv(input_csv, chunksize=chunk_size)
+    if jobs is None or jobs <= 1:
+        for chunk in reader:
+            statistics.merge(chunk_statistics(chunk, relative_accuracy))
+        return statistics
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # a bounded number of chunks is in flight, to keep memory bounded
+        pending = deque()
+        for chunk in reader:
+            pending.append(executor.submit(chunk_statistics, chunk, relative_accuracy))
+            if len(pending) >= 2 * jobs:
+                statistics.merge(pending.popleft().result())
+        while pending:
+            statistics.merge(pending.popleft().result())
+    return statistics
+
+
+def join_sensor_descriptions(argv=None):
     # read arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input-csv', help="Path to input csv with sensor values in columns.")
     parser.add_argument('-sd', '--sensor-description', help="Path to input csv with sensor descriptions.")
     parser.add_argument('-o', '--output-csv', help="Path to output csv with full sensor data.")
-    args = parser.parse_args()
+    parser.add_argument('-cs', '--chunk-size', default=100000, type=int, help="Number of csv rows summarized at once.")
+    parser.add_argument('-j', '--jobs', default=None, type=int, help="[OPTIONAL] Number of worker processes.")
+    parser.add_argument('-qa', '--quantile-accuracy', default=0.01, type=float, help="Relative accuracy of the approximate percentiles.")
+    args = parser.parse_args(argv)
 
     print('Reading sensor values from', args.input_csv)
-    sensor_values = pd.read_csv(open(args.input_csv))
-    print(f'Read {sensor_values.shape[0]} rows and {sensor_values.shape[1]} columns')
+    statistics = describe_csv(args.input_csv, args.chunk_size, args.jobs, args.quantile_accuracy)
+    print(f'Read {statistics.moments.rows} rows and {len(statistics.moments.columns)} sensor columns')
 
     print('Reading sensor descriptions from', args.sensor_description)
     sensor_description = pd.read_csv(open(args.sensor_description), index_col='sensorid')
@@ -71,7 +118,8 @@ def join_sensor_descriptions():
     # change sensor name type to string to match index in sensor_val_stats below
     sensor_description.index = sensor_description.index.map(str)
 
-    sensor_val_stats = sensor_values.describe(include='all').transpose()
+    sensor_val_stats = statistics.describe()
+    sensor_val_stats.index = sensor_val_stats.index.map(str)
     sensor_val_stats.index.name = 'sensorid'
 
     sensor_data = sensor_description.join(sensor_val_stats, how='inner')
@@ -92,13 +140,13 @@ def normalize_timestamp(timestamp_series):
     times = pd.to_datetime(timestamp_series, format='%Y-%m-%d %H:%M:%S').astype(np.int64) // int(1e6)
     return times
 
-def prepare_streamstory_input():
+def prepare_streamstory_input(argv=None):
     # read arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input-csv', help="Path to input csv with sensor values in columns.")
     parser.add_argument('-sd', '--sensor-description', default=None, help="[OPTIONAL] Path to input csv with sensor descriptions. If given, sensor descriptions will be used instead of IDs.")
     parser.add_argument('-o', '--output-csv', help="Path to output csv with sensor data formatted for StreamStory.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     print('Reading sensor values from', args.input_csv)
     sensor_values = pd.read_csv(open(args.input_csv))
@@ -125,6 +173,17 @@ def prepare_streamstory_input():
     component_data.to_csv(args.output_csv)
 
 
+# functions run by the commands of the script
+COMMANDS = {
+    'load': load_DB_and_reshape,
+    'describe': join_sensor_descriptions,
+    'prepare': prepare_streamstory_input,
+}
+
+
 if __name__ == "__main__":
-    # prepare_streamstory_input()
     # graph = stateGraph.StateGraph(5)
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(__doc__)
+        sys.exit(1 if len(sys.argv) > 1 else 0)
+    COMMANDS[sys.argv[1]](sys.argv[2:])
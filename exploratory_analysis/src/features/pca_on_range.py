@@ -9,16 +9,21 @@ the correct format and missing values are replaced with mean value. Results
 before and after replacing are saved as csv. Next, PCA is applied, components_
 and singular_values_ are saved as npy.
 
-For 1 year of data, the script runs a few minutes.
+For 1 year of data, the script runs a few minutes. For longer ranges, set
+chunk_size(-cs): the range is then streamed from the database twice in chunks,
+first to compute the mean and variance of each sensor, then to impute,
+standardize and fit an incremental PCA, so memory stays bounded. Use a cache
+location(-cl) to read the range from the database only once.
 """
 
 import os
+import time
 import pyodbc
 import argparse
 import pandas as pd
 import numpy as np
 from sklearn.impute import SimpleImputer
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.preprocessing import StandardScaler
 from dotenv import load_dotenv
 
@@ -28,11 +33,84 @@ if os.path.exists("../.env"):
 else:
     raise RuntimeError("Expecting .env file with settings.")
 
-from src.data.jems_data import DieselDs
-
-def write_to_table(row, table):
-    """Write a sensor row to a table."""
-    table.loc[row['timestamp'], row['sensors_id']] = row['value']
+from src.data.jems_data import DieselDs, reshape_sensor_data, VALUE_COLUMNS
+from src.data.historian_cache import HistorianCache
+from src.data.pivot import pivot_sensor_chunks
+from src.features.streaming_stats import RunningMoments
+
+
+class Progress:
+    """Prints the number of processed rows and the throughput of a pass over the data."""
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.start = time.perf_counter()
+
+    def update(self, rows):
+        self.rows += rows
+        elapsed = time.perf_counter() - self.start
+        print(f'\r{self.name}: {self.rows} rows, {self.rows / max(elapsed, 1e-9):.0f} rows/s', end='', flush=True)
+
+    def close(self):
+        print()
+
+
+def stream_table(dt, args):
+    """Stream the range as dataframes where each column represents one sensor."""
+    chunks = dt.load_range_chunks(args.start_date, args.end_date, "hour", chunksize=args.chunk_size,
+                                  columns=VALUE_COLUMNS)
+    return pivot_sensor_chunks(chunks)
+
+
+def incremental_pca(dt, args):
+    """
+    Out-of-core version of the in-memory steps in main: mean imputation,
+    standardization and PCA over two passes of the streamed range. Saves the
+    same csv files and returns the fitted IncrementalPCA and the sensor ids of
+    its features.
+    """
+    # first pass: running mean and variance of each sensor
+    moments = RunningMoments()
+    progress = Progress('Statistics')
+    for table in stream_table(dt, args):
+        moments.update(table)
+        progress.update(len(table))
+    progress.close()
+
+    # sensors without values are dropped, as by SimpleImputer
+    observed = moments.count > 0
+    columns = moments.columns[observed]
+    means = pd.Series(moments.mean[observed], index=columns)
+    # mean imputation does not change the mean and the squared deviations, so the
+    # variance of an imputed sensor is over all rows (as in StandardScaler)
+    scale = np.sqrt(moments.m2[observed] / moments.rows)
+    scale[scale == 0] = 1
+    n_components = min(len(columns), moments.rows)
+    pca = IncrementalPCA(n_components=n_components)
+
+    # second pass: impute, standardize and fit in batches, keeping at least
+    # n_components rows for the last batch
+    buffer, buffered = [], 0
+    progress = Progress('PCA')
+    for i, table in enumerate(stream_table(dt, args)):
+        table = table.reindex(columns=moments.columns)
+        table.to_csv(os.path.join(args.save_location, 'sensor_values.csv'), mode='a' if i else 'w', header=not i)
+        imputed = table[columns].fillna(means)
+        imputed.to_csv(os.path.join(args.save_location, 'sensor_values_without_nan.csv'), mode='a' if i else 'w',
+                       header=not i)
+
+        buffer.append(((imputed - means) / scale).to_numpy())
+        buffered += len(imputed)
+        if buffered >= 2 * n_components:
+            batch = np.concatenate(buffer)
+            pca.partial_fit(batch[:-n_components])
+            buffer, buffered = [batch[-n_components:]], n_components
+        progress.update(len(table))
+    if buffered > 0:
+        pca.partial_fit(np.concatenate(buffer))
+    progress.close()
+
+    return pca, columns
 
 
 if __name__ == "__main__":
@@ -43,6 +121,9 @@ if __name__ == "__main__":
     parser.add_argument('-e', '--end-date', default="2017-01-22", help="End of interval to analyse. \
                         Date must be given as 'YYYY-MM-DD hh:mm:ss' or as any prefix of it.", metavar='E')
     parser.add_argument('-l', '--save-location', default="results/", help="Location for saving results", metavar='L')
+    parser.add_argument('-cl', '--cache-location', default=None, help="[OPTIONAL] Location of the local cache of DB values.", metavar='C')
+    parser.add_argument('--offline', action='store_true', help="Use only values from the cache, without connecting to the DB.")
+    parser.add_argument('-cs', '--chunk-size', default=0, type=int, help="[OPTIONAL] Stream the range in chunks of this many DB rows and use incremental PCA.")
     args = parser.parse_args()
 
     # check if save location is a valid path
@@ -50,31 +131,35 @@ if __name__ == "__main__":
         raise RuntimeError("Save location must be a valid path.")
 
     # initialize Diesel data source
-    dt = DieselDs(os.getenv("DB_PASSWORD"))
-
-    # get sensor values for each hour between start and end date
-    values = dt.load_range(args.start_date, args.end_date, "hour")
-
-    # create dataframe where each column represents one sensor
-    table = pd.DataFrame(index = values["timestamp"].unique(), columns = values["sensors_id"].unique())
-    values.apply(lambda row: write_to_table(row, table) , axis=1)
-    table.to_csv(os.path.join(args.save_location, 'sensor_values.csv'))
-
-    # create dataframe where NaN are replaced by mean value of a column
-    imp_mean = SimpleImputer(missing_values=np.nan, strategy='mean')
-    new_table = pd.DataFrame(data = imp_mean.fit_transform(table),
-                            index = values["timestamp"].unique(),
-                            columns = values["sensors_id"].unique())
-    new_table.to_csv(os.path.join(args.save_location, 'sensor_values_without_nan.csv'))
-
-    # standardize the data
-    new_table = pd.DataFrame(data = StandardScaler().fit_transform(new_table),
-                                index = new_table.index, columns = new_table.columns)
-
-    # PCA
-    pca = PCA()
-    principal_components = pca.fit_transform(new_table)
-    principal_components = pd.DataFrame(principal_components)
+    cache = HistorianCache(args.cache_location) if args.cache_location is not None else None
+    dt = DieselDs(os.getenv("DB_PASSWORD"), cache=cache, offline=args.offline)
+
+    if args.chunk_size > 0:
+        pca, columns = incremental_pca(dt, args)
+    else:
+        # get sensor values for each hour between start and end date
+        values = dt.load_range(args.start_date, args.end_date, "hour", columns=VALUE_COLUMNS)
+
+        # create dataframe where each column represents one sensor
+        table = reshape_sensor_data(values)
+        table.to_csv(os.path.join(args.save_location, 'sensor_values.csv'))
+
+        # create dataframe where NaN are replaced by mean value of a column
+        imp_mean = SimpleImputer(missing_values=np.nan, strategy='mean')
+        new_table = pd.DataFrame(data = imp_mean.fit_transform(table),
+                                index = table.index,
+                                columns = table.columns)
+        new_table.to_csv(os.path.join(args.save_location, 'sensor_values_without_nan.csv'))
+
+        # standardize the data
+        new_table = pd.DataFrame(data = StandardScaler().fit_transform(new_table),
+                                    index = new_table.index, columns = new_table.columns)
+
+        # PCA
+        pca = PCA()
+        principal_components = pca.fit_transform(new_table)
+        principal_components = pd.DataFrame(principal_components)
+        columns = table.columns
 
     # save components and singular values
     np.save(os.path.join(args.save_location, 'components'), pca.components_)
@@ -82,12 +167,12 @@ if __name__ == "__main__":
 
     # print information about the sensor which has the biggest absolute value of coefficient
     # in vector that points in direction of the biggest variance
-    sensor = table.columns[np.argmax(np.abs(pca.components_[0]))]
+    sensor = columns[np.argmax(np.abs(pca.components_[0]))]
     print("Sensor with the biggest coefficient:")
     print(dt.sdf[dt.sdf.sensorid == sensor].to_string())
 
     # create list of sensor ids from most important sensor to the least important one
     sensor_importance = []
     for component in pca.components_:
-        sensor_importance.append(table.columns[np.argmax(np.abs(component))])
+        sensor_importance.append(columns[np.argmax(np.abs(component))])
     np.save(os.path.join(args.save_location, 'sensor_importance'), sensor_importance)
\ No newline at end of file
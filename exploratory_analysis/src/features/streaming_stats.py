@@ -0,0 +1,212 @@
+"""
+Mergeable one-pass statistics of sensor values. Statistics are computed chunk by
+chunk, so time ranges larger than memory can be described, and partial results
+of different chunks or workers can be merged exactly.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class RunningMoments:
+    """
+    Count, mean and sum of squared deviations from the mean (M2) of each column
+    of a stream of dataframes, ignoring missing values. Two partial results are
+    merged with the parallel variance formulas of Chan et al., so the result
+    does not depend on how the data was split.
+
+    Attributes:
+        columns: Index of columns seen so far (sorted).
+        rows: number of rows seen so far.
+        count: ndarray with the number of non-missing values of each column.
+        mean: ndarray with the mean of each column.
+        m2: ndarray with the sum of squared deviations from the mean of each column.
+    """
+    def __init__(self):
+        self.columns = pd.Index([])
+        self.rows = 0
+        self.count = np.zeros(0)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+
+    def update(self, chunk):
+        """Add the values of a chunk with one column per sensor. Returns self."""
+        values = chunk.to_numpy(dtype=np.float64)
+        observed = ~np.isnan(values)
+        part = RunningMoments()
+        part.columns = pd.Index(chunk.columns)
+        part.rows = values.shape[0]
+        part.count = observed.sum(axis=0).astype(np.float64)
+        part.mean = np.divide(np.where(observed, values, 0).sum(axis=0), part.count,
+                              out=np.zeros(values.shape[1]), where=part.count > 0)
+        part.m2 = (np.where(observed, values - part.mean, 0) ** 2).sum(axis=0)
+        return self.merge(part)
+
+    def aligned(self, columns):
+        """Return count, mean and m2 of the given columns, zero for unseen columns."""
+        index = self.columns.get_indexer(columns)
+        seen = index >= 0
+        return tuple(np.where(seen, values[index], 0.0) if len(values) else np.zeros(len(columns))
+                     for values in (self.count, self.mean, self.m2))
+
+    def merge(self, other):
+        """Merge the statistics of another RunningMoments into this one. Returns self."""
+        columns = other.columns if len(self.columns) == 0 else self.columns.union(other.columns)
+        count_a, mean_a, m2_a = self.aligned(columns)
+        count_b, mean_b, m2_b = other.aligned(columns)
+
+        count = count_a + count_b
+        delta = mean_b - mean_a
+        with np.errstate(invalid='ignore', divide='ignore'):
+            share = np.where(count > 0, count_b / count, 0.0)
+        self.mean = mean_a + delta * share
+        self.m2 = m2_a + m2_b + delta ** 2 * count_a * share
+        self.count = count
+        self.columns = columns
+        self.rows += other.rows
+        return self
+
+    def var(self, ddof=0):
+        """Variance of each column (NaN for columns with too few values)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan)
+        return pd.Series(var, index=self.columns)
+
+    def std(self, ddof=0):
+        """Standard deviation of each column (NaN for columns with too few values)."""
+        return np.sqrt(self.var(ddof))
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles of each column of a stream of dataframes with a
+    relative error guarantee, in the manner of DDSketch (Masson et al.). Values
+    are counted in logarithmic buckets, so a sketch takes a few thousand buckets
+    per column regardless of the number of values, and two sketches are merged
+    exactly by adding the bucket counts.
+
+    Attributes:
+        relative_accuracy: relative error of the returned quantiles.
+        counts: Series of bucket counts indexed by (column, bucket code).
+    """
+    # bucket codes are offset so that the codes of negative values, zero and
+    # positive values do not overlap and are ordered as the values
+    OFFSET = 2 ** 20
+    # codes lie strictly between -2 * OFFSET and 2 * OFFSET, keys of (column, code) pairs are
+    # column * KEY_SPAN + code + KEY_SPAN / 2
+    KEY_SPAN = 2 ** 22
+
+    def __init__(self, relative_accuracy=0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.counts = pd.Series([], dtype=np.int64,
+                                index=pd.MultiIndex.from_arrays([[], []], names=['column', 'code']))
+
+    def codes(self, values):
+        """Bucket codes of the (non-missing) values."""
+        with np.errstate(divide='ignore'):
+            keys = np.log(np.abs(values))
+        keys /= np.log(self.gamma)
+        np.ceil(keys, out=keys)
+        # zero gets the code 0 through its sign
+        np.clip(keys, 1 - self.OFFSET, self.OFFSET - 1, out=keys)
+        keys += self.OFFSET
+        keys *= np.sign(values)
+        return keys.astype(np.int64)
+
+    def values(self, codes):
+        """Representative values of the buckets with the given codes."""
+        keys = np.abs(codes) - self.OFFSET
+        return np.sign(codes) * 2 * self.gamma ** keys / (self.gamma + 1)
+
+    def update(self, chunk):
+        """Add the values of a chunk with one column per sensor. Returns self."""
+        values = chunk.to_numpy(dtype=np.float64)
+        observed = ~np.isnan(values)
+        codes = self.codes(values[observed])
+        cols = np.broadcast_to(np.arange(values.shape[1]), values.shape)[observed]
+        if len(codes) == 0:
+            return self
+        # count the occupied buckets of all columns at once; codes of values of both
+        # signs lie about 2 * OFFSET apart, so only the keys that occur are counted
+        keys, counts = np.unique(cols * self.KEY_SPAN + (codes + self.KEY_SPAN // 2), return_counts=True)
+        cols, codes = np.divmod(keys, self.KEY_SPAN)
+        part = pd.Series(counts, index=pd.MultiIndex.from_arrays([chunk.columns[cols], codes - self.KEY_SPAN // 2],
+                                                                 names=['column', 'code']))
+        return self.merge(part)
+
+    def merge(self, other):
+        """Merge the bucket counts of another QuantileSketch (or a Series of counts) into this one. Returns self."""
+        counts = other.counts if isinstance(other, QuantileSketch) else other
+        if isinstance(other, QuantileSketch) and other.gamma != self.gamma:
+            raise ValueError("Only sketches with the same relative accuracy can be merged.")
+        if len(self.counts) == 0:
+            self.counts = counts.copy()
+        elif len(counts) > 0:
+            self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+        return self
+
+    def quantiles(self, q):
+        """Approximate quantiles q (list of values between 0 and 1) of each column."""
+        q = np.asarray(q, dtype=np.float64)
+        result = {}
+        for column, counts in self.counts.groupby(level='column', sort=True):
+            codes = counts.index.get_level_values('code').to_numpy()
+            order = np.argsort(codes)
+            cumulative = np.cumsum(counts.to_numpy()[order])
+            # bucket holding the value of rank q * (n - 1)
+            bucket = np.searchsorted(cumulative, q * (cumulative[-1] - 1), side='right')
+            result[column] = self.values(codes[order][bucket])
+        return pd.DataFrame.from_dict(result, orient='index', columns=list(q))
+
+
+class SensorStatistics:
+    """
+    Mergeable one-pass summary of each column of a stream of dataframes: count,
+    mean, standard deviation, min, max, approximate quantiles and the number of
+    missing values. Partial summaries of different chunks, files or workers are
+    merged exactly, so the summary of a multi-year export does not depend on
+    how it was split.
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.moments = RunningMoments()
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.minimum = pd.Series([], dtype=np.float64)
+        self.maximum = pd.Series([], dtype=np.float64)
+
+    def update(self, chunk):
+        """Add the values of a chunk with one column per sensor. Returns self."""
+        part = SensorStatistics(self.sketch.relative_accuracy)
+        part.moments.update(chunk)
+        part.sketch.update(chunk)
+        part.minimum = chunk.min()
+        part.maximum = chunk.max()
+        return self.merge(part)
+
+    def merge(self, other):
+        """Merge the statistics of another SensorStatistics into this one. Returns self."""
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+        self.minimum = pd.concat([self.minimum, other.minimum], axis=1).min(axis=1)
+        self.maximum = pd.concat([self.maximum, other.maximum], axis=1).max(axis=1)
+        return self
+
+    def describe(self, percentiles=(0.25, 0.5, 0.75)):
+        """
+        Summary with one row per column, in the layout of DataFrame.describe().transpose()
+        with additional columns 'missing' and 'missing_ratio'. Percentiles are approximate.
+        """
+        columns = self.moments.columns
+        count, mean, _ = self.moments.aligned(columns)
+        stats = pd.DataFrame({'count': count, 'mean': np.where(count > 0, mean, np.nan),
+                              'std': self.moments.std(ddof=1).to_numpy()}, index=columns)
+        stats['min'] = self.minimum.reindex(columns)
+        quantiles = self.sketch.quantiles(percentiles).reindex(columns)
+        for p in percentiles:
+            stats[f'{100 * p:g}%'] = quantiles[p]
+        stats['max'] = self.maximum.reindex(columns)
+        stats['missing'] = self.moments.rows - count
+        stats['missing_ratio'] = stats['missing'] / max(self.moments.rows, 1)
+        return stats
@@ -1,8 +1,10 @@
 """
 Script that runs HoeffdingTreeClassifier and SGDClassifier on datasets with different number
 of states, different sets of sensors and with different window sizes. It creates csv file
-with the measurements. If data is scaled before learning, the csv is called
-'results_stream_normalized.csv', otherwise it is called 'results_stream.csv'.
+with the measurements, including training and testing time per sample of the prequential
+evaluation (seconds). If
+data is scaled before learning, the csv is called 'results_stream_normalized.csv', otherwise it
+is called 'results_stream.csv'.
 """
 
 import pandas as pd
@@ -34,7 +36,7 @@ def train(name, clusters, window, normalize=False):
     hf = HoeffdingTreeClassifier()
     sgd = SGDClassifier()
 
-    evaluator = EvaluatePrequential()
+    evaluator = EvaluatePrequential(metrics=['accuracy', 'precision', 'recall', 'f1', 'running_time'])
     evaluator.evaluate(stream=stream, model=[hf, sgd])
     # print('---------------------------------------------')
     # measurements = evaluator.get_mean_measurements()[0]
@@ -42,14 +44,19 @@ def train(name, clusters, window, normalize=False):
     # print(measurements.accuracy_score())
     data = []
     for i, measurements in enumerate(evaluator.get_mean_measurements()):
+        running_time = evaluator.running_time_measurements[i]
         data.append([name, clusters, window, MODEL_NAMES[i], normalize, measurements.accuracy_score(),
-                    measurements.precision_score(), measurements.recall_score(), measurements.f1_score()])
+                    measurements.precision_score(), measurements.recall_score(), measurements.f1_score(),
+                    running_time.get_current_training_time() / evaluator.global_sample_count,
+                    running_time.get_current_testing_time() / evaluator.global_sample_count])
     return pd.DataFrame(data=data,
-                        columns=['name', 'clusters', 'window', 'model', 'normalized', 'accuracy', 'precision', 'recall', 'f1'])
+                        columns=['name', 'clusters', 'window', 'model', 'normalized', 'accuracy', 'precision', 'recall', 'f1',
+                                 'fit_time_per_row', 'predict_time_per_row'])
 
 
 def train_all_datasets(normalize=False):
-    results = pd.DataFrame(columns=['name', 'clusters', 'window', 'model', 'normalized', 'accuracy', 'precision', 'recall', 'f1'])
+    results = pd.DataFrame(columns=['name', 'clusters', 'window', 'model', 'normalized', 'accuracy', 'precision', 'recall', 'f1',
+                                    'fit_time_per_row', 'predict_time_per_row'])
     counter = 0
     for name in ['B100', 'B200', 'B200_subset', 'B300']:
         for clusters in [5, 10, 15, 20]:
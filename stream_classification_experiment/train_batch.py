@@ -1,21 +1,42 @@
 """
-Script that runs RandomForest, GradientBoosting and DecisionTree on datasets with different
-number of states, different sets of sensors and with different window sizes. It creates csv
-file with the measurements. If data is scaled before learning, the csv is called
-'results_batch_normalized.csv', otherwise it is called 'results_batch.csv'.
+Script that runs RandomForest, GradientBoosting, HistGradientBoosting and DecisionTree on
+datasets with different number of states, different sets of sensors and with different window
+sizes. It creates csv file with the measurements, including fit time per training row and
+predict time per predicted row (seconds), so the cost is comparable between the evaluations
+and with the stream models of train.py. If data is scaled before learning, the csv is called 'results_batch_normalized.csv', otherwise it is
+called 'results_batch.csv'.
+
+Models are evaluated either on a shuffled train/test split or, with '--track time', on
+time-ordered forward-chaining folds (TimeSeriesSplit: each fold is trained on all rows before
+its test rows), which are run in parallel. The time-ordered results are saved to
+'results_batch_time.csv' and 'results_batch_time_normalized.csv'.
 """
 
+import time
+import argparse
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import train_test_split
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.model_selection import train_test_split, TimeSeriesSplit
+from sklearn.pipeline import make_pipeline
+from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier, HistGradientBoostingClassifier
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.linear_model import LogisticRegression
 from sklearn import metrics
 
 
 DATA_LOCATION = '../data/'
+RESULT_COLUMNS = ['name', 'clusters', 'window', 'model', 'normalized', 'accuracy', 'precision', 'recall', 'f1',
+                  'fit_time_per_row', 'predict_time_per_row']
+MODELS = {
+    'RandomForestClassifier': RandomForestClassifier,
+    'GradientBoostingClassifier': GradientBoostingClassifier,
+    'HistGradientBoostingClassifier': HistGradientBoostingClassifier,
+    'DecisionTreeClassifier': DecisionTreeClassifier,
+}
 
 
 def train(name, clusters, window, model, model_name, normalize=False):
@@ -34,43 +55,97 @@ def train(name, clusters, window, model, model_name, normalize=False):
 
     x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.3)
 
+    start = time.perf_counter()
     model.fit(x_train, np.transpose(y_train.values)[0])
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
     y_pred = model.predict(x_test)
+    predict_time = time.perf_counter() - start
 
     report = metrics.classification_report(y_test, y_pred, output_dict=True)
 
     results = []
     results.append([name, clusters, window, model_name, normalize, report['accuracy'],
-                    report['macro avg']['precision'], report['macro avg']['recall'], report['macro avg']['f1-score']])
-    return pd.DataFrame(data=results,
-                        columns=['name', 'clusters', 'window', 'model', 'normalized', 'accuracy', 'precision', 'recall', 'f1'])
+                    report['macro avg']['precision'], report['macro avg']['recall'], report['macro avg']['f1-score'],
+                    fit_time / len(x_train), predict_time / len(x_test)])
+    return pd.DataFrame(data=results, columns=RESULT_COLUMNS)
+
+
+def train_fold(model, x, y, train_index, test_index):
+    """Fit a copy of the model on one fold. Returns its scores, fit and predict time and numbers of rows."""
+    model = clone(model)
+    start = time.perf_counter()
+    model.fit(x.iloc[train_index], y[train_index])
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    y_pred = model.predict(x.iloc[test_index])
+    predict_time = time.perf_counter() - start
+
+    report = metrics.classification_report(y[test_index], y_pred, output_dict=True, zero_division=0)
+    return [report['accuracy'], report['macro avg']['precision'], report['macro avg']['recall'],
+            report['macro avg']['f1-score'], fit_time, predict_time, len(train_index), len(test_index)]
+
+
+def train_time_ordered(name, clusters, window, model, model_name, normalize=False, n_splits=5, n_jobs=-1):
+    """
+    Evaluate the model on time-ordered forward-chaining folds, which are fitted in parallel (n_jobs processes).
+    Scores are averaged over the folds. Fit and predict time are summed over the folds and divided by the total
+    number of training and predicted rows, as the training sets of the folds grow.
+    """
+    input_csv = '{}{}_clusters={}_window={}_prepared.csv'.format(DATA_LOCATION, name, clusters, window)
+    data = pd.read_csv(input_csv, index_col=0)
 
+    y = data['next_state'].values
+    x = data.drop(columns='next_state')
+    if normalize:
+        # scaler is fitted on the training rows of each fold, states are not scaled (as in train)
+        sensors = [column for column in x.columns if column != 'current_state']
+        scaler = ColumnTransformer([('sensors', StandardScaler(), sensors)], remainder='passthrough')
+        model = make_pipeline(scaler, model)
+
+    folds = Parallel(n_jobs=n_jobs)(delayed(train_fold)(model, x, y, train_index, test_index)
+                                    for train_index, test_index in TimeSeriesSplit(n_splits=n_splits).split(x))
+    folds = np.array(folds)
+
+    results = [[name, clusters, window, model_name, normalize, *folds[:, :4].mean(axis=0),
+                folds[:, 4].sum() / folds[:, 6].sum(), folds[:, 5].sum() / folds[:, 7].sum()]]
+    return pd.DataFrame(data=results, columns=RESULT_COLUMNS)
 
-def train_all_datasets(normalize=False):
-    results = pd.DataFrame(columns=['name', 'clusters', 'window', 'model', 'normalized', 'accuracy', 'precision', 'recall', 'f1'])
+
+def train_all_datasets(normalize=False, time_ordered=False, n_splits=5, n_jobs=-1):
+    results = []
     counter = 0
     for name in ['B100', 'B200', 'B200_subset', 'B300']:
         for clusters in [5, 10, 15, 20]:
             for window in [5, 10, 20, 50, 100]:
                 print('\n{} / 80'.format(counter + 1))
-                output = train(name, clusters, window, RandomForestClassifier(), 'RandomForestClassifier', normalize)
-                results = results.append(output, ignore_index=True)
-                output = train(name, clusters, window, GradientBoostingClassifier(), 'GradientBoostingClassifier', normalize)
-                results = results.append(output, ignore_index=True)
-                output = train(name, clusters, window, DecisionTreeClassifier(), 'DecisionTreeClassifier', normalize)
-                results = results.append(output, ignore_index=True)
+                for model_name, model in MODELS.items():
+                    if time_ordered:
+                        output = train_time_ordered(name, clusters, window, model(), model_name, normalize, n_splits,
+                                                    n_jobs)
+                    else:
+                        output = train(name, clusters, window, model(), model_name, normalize)
+                    results.append(output)
                 #output = train(name, clusters, window, LogisticRegression(), 'LogisticRegression', normalize)
-                #results = results.append(output, ignore_index=True)
+                #results.append(output)
                 counter += 1
-    if normalize:
-        results.to_csv('../../results/results_batch_normalized.csv')
-    else:
-        results.to_csv('../../results/results_batch.csv')
+    results = pd.concat(results, ignore_index=True)
+    output_csv = '../../results/results_batch{}{}.csv'.format('_time' if time_ordered else '',
+                                                              '_normalized' if normalize else '')
+    results.to_csv(output_csv)
 
 if __name__ == '__main__':
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--track', default='split', choices=('split', 'time', 'all'), help="Evaluate on a shuffled train/test split, on time-ordered folds or both.")
+    parser.add_argument('-n', '--n-splits', default=5, type=int, help="Number of time-ordered folds.")
+    parser.add_argument('-j', '--jobs', default=-1, type=int, help="Number of folds fitted in parallel (-1 for all cores).")
+    args = parser.parse_args()
+
     # print(train('B100', 5, 5, RandomForestClassifier(), 'RandomForestClassifier'))
     # print('----------------------------------------------')
     # print(train('B100', 5, 5, True))
-    train_all_datasets()
-    print('----------------------------------------------')
-    train_all_datasets(normalize=True)
+    for time_ordered in {'split': [False], 'time': [True], 'all': [False, True]}[args.track]:
+        train_all_datasets(time_ordered=time_ordered, n_splits=args.n_splits, n_jobs=args.jobs)
+        print('----------------------------------------------')
+        train_all_datasets(normalize=True, time_ordered=time_ordered, n_splits=args.n_splits, n_jobs=args.jobs)
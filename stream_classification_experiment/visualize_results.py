@@ -1,13 +1,18 @@
 """
-Script that draws 4 graphs:
+Script that draws 5 graphs:
     1. Graph of average f1 score for each machine learning method (if name of the method ends with 'normalized',
         it means that data was normalized before learning).
     2. Graph of average f1 score for each window size for each machine learning method.
     3. Graph of average f1 score for each component for each machine learning method (component 'B200_subset' has just
         sensors: ['7', '9', '11', '12', '31', '34', '39', '52', '56', '58', '66', '67', '73', '74', '75']).
     4. Graph of average f1 score for each number of clusters for each machine learning method.
+    5. Graph of average fit time per training row and predict time per predicted row for each machine learning
+        method (results without times are skipped).
+Batch results evaluated on time-ordered folds (results_batch_time*.csv), if present, are shown as methods
+ending with '_time_ordered'.
 """
 
+import os
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
@@ -15,6 +20,7 @@ from plotly.subplots import make_subplots
 
 input_location = '../../results/'
 input_data = ['results_stream.csv', 'results_stream_normalized.csv', 'results_batch.csv', 'results_batch_normalized.csv']
+optional_input_data = ['results_batch_time.csv', 'results_batch_time_normalized.csv']
 
 
 # function that creates column combining columns 'model' and 'normalized'
@@ -44,7 +50,12 @@ def create_figure(x_name):
 data = pd.read_csv(input_location + input_data[0], index_col=0)
 for file in input_data[1:]:
     tmp = pd.read_csv(input_location + file, index_col=0)
-    data = data.append(tmp, ignore_index=True)
+    data = pd.concat([data, tmp], ignore_index=True)
+for file in optional_input_data:
+    if os.path.exists(input_location + file):
+        tmp = pd.read_csv(input_location + file, index_col=0)
+        tmp['model'] = tmp['model'] + '_time_ordered'
+        data = pd.concat([data, tmp], ignore_index=True)
 
 data['model_normalized'] = data.apply(combine, axis='columns')
 
@@ -69,3 +80,14 @@ fig.write_html("../../results/model_window_avg_f1.html", include_plotlyjs='cdn',
 
 create_figure('name')
 create_figure('clusters')
+
+
+# plot of average fit and predict time per row for each machine learning method
+if 'fit_time_per_row' in data.columns:
+    times = data.dropna(subset=['fit_time_per_row']).groupby('model_normalized')[['fit_time_per_row',
+                                                                                   'predict_time_per_row']].mean()
+    fig = go.Figure(data=[go.Bar(name='fit time per training row', x=times.index, y=times['fit_time_per_row']),
+                          go.Bar(name='predict time per predicted row', x=times.index,
+                                 y=times['predict_time_per_row'])])
+    fig.update_layout(barmode='group', yaxis_type='log', yaxis_title='seconds per row')
+    fig.write_html("../../results/model_avg_time.html", include_plotlyjs='cdn', full_html=False)
@@ -0,0 +1,126 @@
+"""
+Backfill - labels and next-state predictions for a long history in parallel.
+
+The history (timestamp index, one column per sensor of a fitted StateGraph) is
+copied into shared memory once and split into chunks of consecutive rows. Each
+chunk is processed by a worker of a process pool:
+    - rows are labeled with StateGraph.predict,
+    - transitions between consecutive different states are counted,
+    - TransitionModel features and next-state predictions are computed.
+A chunk starts window_size-1 rows before its own rows (at least one row), so the
+running averages and deltas of its first rows and the transition from the last
+row of the previous chunk are the same as in a single pass. Results of the chunks
+are concatenated in order and their transition counts summed, which gives the
+output of a serial run.
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+
+from state_graph import StateGraph, count_transitions, normalize_rows
+from transition_model import TransitionModel
+from components import SharedArray
+from service import load_pickle
+
+# graph, model and shared values of a worker, set by init_worker
+_worker = {}
+
+
+def init_worker(graph: StateGraph, model: TransitionModel, values_handle: tuple, columns: list, threads: int) -> None:
+    """Keep the graph, model and attached values in the worker, so chunks are sent as row ranges only."""
+    # drift is not monitored on historical data
+    graph.monitor = None
+    _worker.update(graph=graph, model=model, values=SharedArray.attach(values_handle), columns=columns)
+    threadpool_limits(limits=threads)
+
+
+def chunk_bounds(n_rows: int, chunk_size: int, context: int) -> list:
+    """Return (start, own_start, end) of chunks with own rows own_start:end preceded by up to context rows."""
+    return [(max(own_start - context, 0), own_start, min(own_start + chunk_size, n_rows))
+            for own_start in range(0, n_rows, chunk_size)]
+
+
+def backfill_chunk(start: int, own_start: int, end: int):
+    """Label rows start:end of the shared values (in a worker). Returns labels and next states of the own rows and
+    transition counts from the row before own_start to end."""
+    graph, model = _worker['graph'], _worker['model']
+    data = pd.DataFrame(_worker['values'].array()[start:end], columns=_worker['columns'])
+    labels = graph.predict(data)
+    counts = count_transitions(labels[max(own_start - start - 1, 0):], graph.n_clusters)
+
+    # features exist from row window_size-1 of the chunk, rows before it get no prediction
+    next_state = np.full(len(data), -1)
+    if model is not None and len(data) >= model.window_size:
+        data['label'] = labels
+        next_state[model.window_size-1:] = model.predict(data, use_history=False)
+    own = slice(own_start - start, None)
+    return labels[own], next_state[own], counts
+
+
+def backfill(table: pd.DataFrame, graph: StateGraph, model: TransitionModel = None, chunk_size: int = 100000,
+             max_workers: int = None):
+    """
+    Label the table with the graph and predict next states with the model (if given)
+    in parallel chunks. Returns a DataFrame with columns 'label' and 'next_state'
+    (-1 for the first window_size-1 rows) indexed as the table, and the sparse matrix
+    of transition probabilities (as StateGraph.transform would set it).
+    """
+    columns = list(graph.centroids.columns)
+    context = max(model.window_size - 1, 1) if model is not None else 1
+    bounds = chunk_bounds(len(table), chunk_size, context)
+    max_workers = max_workers or min(len(bounds), os.cpu_count() or 1)
+    threads = max(1, (os.cpu_count() or 1) // max_workers)
+
+    values = SharedArray.create(np.ascontiguousarray(table[columns].to_numpy(dtype=np.float64)))
+    labels, next_states = [], []
+    counts = count_transitions([], graph.n_clusters)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(graph, model, values.handle(), columns, threads)) as executor:
+            # map keeps the order of chunks for stitching
+            for chunk_labels, chunk_next_states, chunk_counts in executor.map(backfill_chunk, *zip(*bounds)):
+                labels.append(chunk_labels)
+                next_states.append(chunk_next_states)
+                counts += chunk_counts
+    finally:
+        values.close()
+
+    result = pd.DataFrame({'label': np.concatenate(labels) if labels else np.zeros(0, dtype=np.int64),
+                           'next_state': np.concatenate(next_states) if next_states else np.zeros(0, dtype=np.int64)},
+                          index=table.index)
+    return result, normalize_rows(counts)
+
+
+if __name__ == "__main__":
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help="Csv or parquet with StreamStory input (timestamp in the first column, one column per sensor).")
+    parser.add_argument('-g', '--graph', help="Path to pickled StateGraph (or result of the cluster stage of pipeline.py).")
+    parser.add_argument('-m', '--model', default=None, help="[OPTIONAL] Path to pickled TransitionModel for next-state predictions.")
+    parser.add_argument('-cs', '--chunk-size', default=100000, type=int, help="Number of rows labeled by a worker at once.")
+    parser.add_argument('-j', '--jobs', default=None, type=int, help="[OPTIONAL] Number of worker processes.")
+    parser.add_argument('-o', '--output-csv', default='../data/backfill.csv', help="Path to output csv with labels and next states.")
+    parser.add_argument('-t', '--transitions', default=None, help="[OPTIONAL] Path to output .npz with transition probabilities.")
+    args = parser.parse_args()
+
+    graph = load_pickle(args.graph)
+    model = load_pickle(args.model) if args.model is not None else None
+    table = pd.read_parquet(args.input) if args.input.endswith('.parquet') else pd.read_csv(args.input)
+    table = table.set_index(table.columns[0])
+    table.columns = table.columns.map(str)
+    print(f'Read {table.shape[0]} rows and {table.shape[1]} columns')
+
+    start = time.perf_counter()
+    result, transitions = backfill(table, graph, model, args.chunk_size, args.jobs)
+    seconds = time.perf_counter() - start
+    print(f'Labeled {len(result)} rows in {seconds:.1f} s ({len(result) / max(seconds, 1e-9):.0f} rows/s)')
+    result.to_csv(args.output_csv)
+    if args.transitions is not None:
+        sparse.save_npz(args.transitions, transitions)
+    print(transitions.toarray())
@@ -0,0 +1,148 @@
+"""
+Components - fits one StateGraph per plant component concurrently.
+
+The wide sensor table (timestamp index, one column per sensor) is loaded once and
+copied into shared memory. Each worker of a process pool attaches to it without
+copying, takes the columns of one component (see COMPONENT_SENSORS in
+exploratory_analysis) and fits a StateGraph on the rows where all of them are
+present. Components with more sensors are submitted first, so the plant model
+builds in about the time of the slowest component.
+"""
+
+import os
+import time
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy import sparse
+from threadpoolctl import threadpool_limits
+
+from state_graph import StateGraph
+from pipeline import exploratory_analysis_src
+
+
+class SharedArray(object):
+    """A numpy array in shared memory, attachable from other processes by its handle."""
+    def __init__(self, shm: shared_memory.SharedMemory, shape: tuple, dtype, owner: bool) -> None:
+        self.shm = shm
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.owner = owner
+
+    @classmethod
+    def create(cls, values: np.ndarray) -> 'SharedArray':
+        """Copy values into a new shared memory block."""
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        shared = cls(shm, values.shape, values.dtype, owner=True)
+        shared.array()[...] = values
+        return shared
+
+    @classmethod
+    def attach(cls, handle: tuple) -> 'SharedArray':
+        """Attach to the shared memory block of a handle (see handle)."""
+        name, shape, dtype = handle
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype, owner=False)
+
+    def handle(self) -> tuple:
+        """Picklable description of the block for attach."""
+        return self.shm.name, self.shape, self.dtype.str
+
+    def array(self) -> np.ndarray:
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def close(self) -> None:
+        """Detach, and free the block if it was created here."""
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def fit_component(values_handle: tuple, index_handle: tuple, columns: list, positions: list, n_clusters: int,
+                  threads: int):
+    """Fit a StateGraph on some columns of the shared table (in a worker). Returns the graph and the time (s)."""
+    start = time.perf_counter()
+    values, index = SharedArray.attach(values_handle), SharedArray.attach(index_handle)
+    try:
+        # copy just the component's columns, the shared table stays untouched
+        data = values.array()[:, positions]
+        complete = ~np.isnan(data).any(axis=1)
+        data = pd.DataFrame(data[complete], index=pd.Index(index.array()[complete], name='timestamp'),
+                            columns=columns)
+    finally:
+        values.close()
+        index.close()
+
+    # limit the threads of KMeans, the workers already run in parallel
+    with threadpool_limits(limits=threads):
+        graph = StateGraph(n_clusters)
+        graph.fit_transform(data)
+    return graph, time.perf_counter() - start
+
+
+def fit_components(table: pd.DataFrame, components: dict, n_clusters: int = 5, max_workers: int = None) -> dict:
+    """
+    Fit a StateGraph for each component concurrently. The 'components' argument maps
+    component names to lists of sensor columns of the table (missing columns are
+    skipped). Returns a dictionary mapping component names to dicts with the fitted
+    'graph' and its 'transitions'.
+    """
+    max_workers = max_workers or min(len(components), os.cpu_count() or 1)
+    threads = max(1, (os.cpu_count() or 1) // max_workers)
+    values = SharedArray.create(np.ascontiguousarray(table.to_numpy(dtype=np.float64)))
+    index = SharedArray.create(table.index.to_numpy())
+    results = {}
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            # largest components first, the others fill in the remaining workers
+            for component, sensors in sorted(components.items(), key=lambda item: -len(item[1])):
+                columns = [sensor for sensor in sensors if sensor in table.columns]
+                if not columns:
+                    print(f'Skipping {component}, none of its sensors are in the table')
+                    continue
+                positions = table.columns.get_indexer(columns).tolist()
+                futures[executor.submit(fit_component, values.handle(), index.handle(), columns, positions,
+                                        n_clusters, threads)] = component
+            for future in as_completed(futures):
+                graph, seconds = future.result()
+                results[futures[future]] = {'graph': graph, 'transitions': graph.transitions}
+                print(f'Fitted {futures[future]} in {seconds:.1f} s')
+    finally:
+        values.close()
+        index.close()
+    return results
+
+
+if __name__ == "__main__":
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help="Csv or parquet with timestamp in the first column and sensor values in columns (sensor ids as names).")
+    parser.add_argument('-c', '--components', nargs='+', default=['all'], help="Components to fit, or 'all'.")
+    parser.add_argument('-k', '--n-clusters', default=5, type=int, help="Number of states of each component.")
+    parser.add_argument('-j', '--jobs', default=None, type=int, help="[OPTIONAL] Number of worker processes.")
+    parser.add_argument('-o', '--output-dir', default='../data', help="Directory for <component>_graph.pkl and <component>_transitions.npz.")
+    args = parser.parse_args()
+
+    exploratory_analysis_src()
+    from src.data.build_ss_input import COMPONENT_SENSORS
+    components = COMPONENT_SENSORS if args.components == ['all'] else \
+        {component: COMPONENT_SENSORS[component] for component in args.components}
+
+    table = pd.read_parquet(args.input) if args.input.endswith('.parquet') else pd.read_csv(args.input)
+    table = table.set_index(table.columns[0])
+    table.columns = table.columns.map(str)
+    # timestamps in shared memory must be numeric, dates are converted to milliseconds
+    if not pd.api.types.is_numeric_dtype(table.index):
+        table.index = pd.to_datetime(table.index).values.astype('datetime64[ms]').astype(np.int64)
+    print(f'Read {table.shape[0]} rows and {table.shape[1]} columns')
+
+    start = time.perf_counter()
+    results = fit_components(table, components, args.n_clusters, args.jobs)
+    print(f'Fitted {len(results)} components in {time.perf_counter() - start:.1f} s')
+    for component, result in results.items():
+        with open(os.path.join(args.output_dir, f'{component}_graph.pkl'), 'wb') as fd:
+            pickle.dump(result['graph'], fd, protocol=pickle.HIGHEST_PROTOCOL)
+        sparse.save_npz(os.path.join(args.output_dir, f'{component}_transitions.npz'), result['transitions'])
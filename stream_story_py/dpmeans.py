@@ -6,6 +6,7 @@ Implemented as described on https://arxiv.org/pdf/1111.0352.pdf (page 6)
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from profiling import profiled
 
 class DPMeans():
     """
@@ -24,6 +25,7 @@ class DPMeans():
         self.cluster_centers_ = None
         self.numclusters =  None
     
+    @profiled("DPMeans.fit")
     def fit(self, data : pd.DataFrame) -> None:
         """Fits the clustering algorithm with the data.
         """
@@ -62,6 +64,7 @@ class DPMeans():
         self.cluster_centers_ = means
         self.numclusters = numclusters
         
+    @profiled("DPMeans.predict")
     def predict(self,data : pd.DataFrame) -> np.ndarray:
         """Clusters the data with the previously fitted parameters.
         Returns a one dimensional numpy array containing the cluster indices for 
@@ -0,0 +1,208 @@
+"""
+Drift - detection of changes of operating regimes and background re-clustering
+of a StateGraph.
+
+DriftMonitor compares the distances to the nearest centroid and the distribution
+of labels on a sliding window of recent data with those of the data the graph was
+fitted on. AdaptiveStateGraph serves labels from its current StateGraph and, when
+the monitor reports drift, fits a new StateGraph on the most recent data in a
+background process. The new states are matched to the old ones (Hungarian
+algorithm on the distances between centroids), so state ids keep their meaning,
+and the new graph replaces the old one with a single assignment. Serving never
+waits for a refit.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+
+from state_graph import StateGraph
+
+
+class DriftMonitor(object):
+    """
+    Tracks drift of the data from the reference data of a StateGraph.
+
+    Attributes:
+        distance_ratio: mean distance to the nearest centroid on the window divided by the reference mean.
+        label_shift: total variation distance between the label distributions of the window and the reference.
+    """
+    def __init__(self, n_clusters: int, window: int = 1000, distance_threshold: float = 1.5,
+                 label_threshold: float = 0.3) -> None:
+        """
+        Arguments:
+            n_clusters -- number of states.
+            window -- number of most recent samples the statistics are computed on.
+            distance_threshold -- drift when the distance ratio is above it.
+            label_threshold -- drift when the label shift (between 0 and 1) is above it.
+        """
+        self.n_clusters = n_clusters
+        self.window = window
+        self.distance_threshold = distance_threshold
+        self.label_threshold = label_threshold
+
+        self.reference_distance = None
+        self.reference_labels = None
+        # ring buffers of the most recent labels and distances
+        self.labels = np.zeros(window, dtype=np.int64)
+        self.distances = np.zeros(window)
+        self.position = 0
+        self.filled = 0
+        self.distance_ratio = 0.0
+        self.label_shift = 0.0
+
+    def set_reference(self, labels: np.ndarray, distances: np.ndarray) -> None:
+        """Set the reference statistics and clear the window."""
+        self.reference_distance = max(float(np.mean(distances)), 1e-12)
+        self.reference_labels = np.bincount(labels, minlength=self.n_clusters) / max(len(labels), 1)
+        self.clear()
+
+    def clear(self) -> None:
+        """Empty the window, drift is reported again only after a full window of new samples."""
+        self.position = 0
+        self.filled = 0
+        self.distance_ratio = 0.0
+        self.label_shift = 0.0
+
+    def update(self, labels: np.ndarray, distances: np.ndarray) -> None:
+        """Add labels and distances of new samples to the window and update the statistics."""
+        labels, distances = labels[-self.window:], distances[-self.window:]
+        slots = (self.position + np.arange(len(labels))) % self.window
+        self.labels[slots] = labels
+        self.distances[slots] = distances
+        self.position = (self.position + len(labels)) % self.window
+        self.filled = min(self.filled + len(labels), self.window)
+        if self.reference_distance is None:
+            return
+
+        self.distance_ratio = self.distances[:self.filled].mean() / self.reference_distance
+        histogram = np.bincount(self.labels[:self.filled], minlength=self.n_clusters) / self.filled
+        self.label_shift = 0.5 * np.abs(histogram - self.reference_labels).sum()
+
+    @property
+    def drifted(self) -> bool:
+        """Whether the full window drifted past one of the thresholds."""
+        return self.filled == self.window and (self.distance_ratio > self.distance_threshold or
+                                               self.label_shift > self.label_threshold)
+
+    def statistics(self) -> dict:
+        return {'distance_ratio': float(self.distance_ratio), 'label_shift': float(self.label_shift),
+                'drifted': bool(self.drifted)}
+
+
+def refit_graph(data: pd.DataFrame, n_clusters: int):
+    """Fit a new StateGraph (in the background worker) and return it with labels and distances of the data."""
+    graph = StateGraph(n_clusters)
+    graph.fit_transform(data)
+    labels, distances = graph.nearest(data)
+    return graph, labels, distances
+
+
+def align_states(old: StateGraph, new: StateGraph) -> np.ndarray:
+    """
+    Return order such that state i of the aligned new graph is state order[i] of the new graph,
+    matching each old state with the closest new state (in the normalised space of the old graph).
+    """
+    cost = cdist(old.normalisation.transform(old.centroids), old.normalisation.transform(new.centroids))
+    old_states, new_states = linear_sum_assignment(cost)
+    order = np.arange(new.n_clusters)
+    order[old_states] = new_states
+    return order
+
+
+def reorder_states(graph: StateGraph, order: np.ndarray) -> None:
+    """Renumber states of the graph in place, state i becomes the former state order[i]."""
+    graph.clustering.cluster_centers_ = graph.clustering.cluster_centers_[order]
+    graph.centroids = graph.centroids.iloc[order].reset_index(drop=True)
+    if graph.transitions is not None:
+        graph.transitions = graph.transitions[order][:, order]
+
+
+class AdaptiveStateGraph(object):
+    """
+    Serves labels of a StateGraph and replaces it with a graph refitted on recent
+    data when drift is detected. Used in place of StateGraph for prediction
+    (e.g. by StreamService).
+
+    Attributes:
+        graph: the current StateGraph.
+        monitor: DriftMonitor of the current graph.
+        refits: number of swapped in graphs.
+        failed_refits: number of refits that raised an error.
+    """
+    def __init__(self, graph: StateGraph, reference: pd.DataFrame, refit_window: int = 10000,
+                 monitor: DriftMonitor = None, executor=None) -> None:
+        """
+        Arguments:
+            graph -- fitted StateGraph.
+            reference -- data the graph was fitted on, for the reference statistics.
+            refit_window -- number of most recent samples a new graph is fitted on.
+            monitor -- DriftMonitor, with default thresholds if None.
+            executor -- executor for refits, a single worker process if None.
+        """
+        self.graph = graph
+        self.monitor = monitor if monitor is not None else DriftMonitor(graph.n_clusters)
+        self.graph.monitor = self.monitor
+        self.monitor.set_reference(*graph.nearest(reference))
+        self.refit_window = refit_window
+        self.executor = executor if executor is not None else ProcessPoolExecutor(max_workers=1)
+        self.recent = []
+        self.recent_rows = 0
+        self.pending = None
+        self.refits = 0
+        self.failed_refits = 0
+
+    @property
+    def n_clusters(self) -> int:
+        return self.graph.n_clusters
+
+    @property
+    def centroids(self) -> pd.DataFrame:
+        return self.graph.centroids
+
+    @property
+    def transitions(self):
+        return self.graph.transitions
+
+    def predict(self, data: pd.DataFrame) -> np.ndarray:
+        """Return labels of the current graph, start a refit on drift and swap in a finished one."""
+        if self.pending is not None and self.pending.done():
+            self.swap()
+        labels = self.graph.predict(data)
+
+        # keep the most recent refit_window samples (a copy, callers may add columns to data)
+        self.recent.append(data.copy())
+        self.recent_rows += len(data)
+        while self.recent_rows - len(self.recent[0]) >= self.refit_window:
+            self.recent_rows -= len(self.recent.pop(0))
+
+        if self.pending is None and self.monitor.drifted:
+            window = pd.concat(self.recent).tail(self.refit_window)
+            self.pending = self.executor.submit(refit_graph, window, self.graph.n_clusters)
+        return labels
+
+    def swap(self) -> None:
+        """Align states of the refitted graph with the current one and replace it."""
+        future, self.pending = self.pending, None
+        try:
+            graph, labels, distances = future.result()
+        except Exception as e:
+            # keep serving with the current graph and retry only after a full window of new samples
+            # still drifts, instead of on every batch
+            self.failed_refits += 1
+            self.monitor.clear()
+            print(f'Refit failed ({self.failed_refits} so far):', e)
+            return
+        order = align_states(self.graph, graph)
+        reorder_states(graph, order)
+        # labels of the aligned graph: former state order[i] is now state i
+        renumber = np.argsort(order)
+        self.monitor.set_reference(renumber[labels], distances)
+        graph.monitor = self.monitor
+        self.graph = graph
+        self.refits += 1
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
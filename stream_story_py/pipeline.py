@@ -0,0 +1,245 @@
+"""
+Pipeline - a single entry point for the whole StreamStoryPy workflow, from sensor
+values to a fitted transition model.
+
+Stages:
+    load -> pivot -> impute -> cluster -> transitions -> features -> model
+
+    - load: long sensor values (timestamp, sensors_id, value) of a time range from
+        the DB, or a csv/parquet file with long values or StreamStory input
+        (timestamp index, one column per sensor)
+    - pivot: wide table with millisecond timestamps as index and one column per sensor
+    - impute: resampling onto an even grid and gap filling, rows that are still
+        incomplete are dropped (TransitionModel expects fully imputed data)
+    - cluster: StateGraph and the data with column 'label'
+    - transitions: matrix of transition probabilities between states
+    - features: running averages and deltas of TransitionModel.prepare_data
+    - model: TransitionModel fitted on the features
+
+Every stage is identified by a hash of its parameters and of the hashes of its
+inputs (for files the hash of their content), and its result is pickled to the
+cache directory under that hash. When the pipeline is run again, stages with an
+unchanged hash are read from the cache, so a parameter change only reruns the
+stages downstream of it.
+
+Database access, pivoting and resampling use the src package of
+exploratory_analysis, which is expected next to this folder.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from state_graph import StateGraph
+from transition_model import TransitionModel
+
+STAGES = ("load", "pivot", "impute", "cluster", "transitions", "features", "model")
+# location of the exploratory_analysis project with the src package
+EXPLORATORY_ANALYSIS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'exploratory_analysis')
+
+
+def exploratory_analysis_src():
+    """Make the src package of exploratory_analysis importable."""
+    if EXPLORATORY_ANALYSIS not in sys.path:
+        sys.path.insert(0, EXPLORATORY_ANALYSIS)
+
+
+def file_hash(path, chunk_size=4096 * 1024):
+    """Return the SHA-256 hash of the content of a file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class StageCache(object):
+    """
+    Stores results of pipeline stages as pickle files named <stage>-<hash>.pkl.
+
+    Attributes:
+        directory: folder with the stored results.
+        force: names of stages that are recomputed even if their result is stored.
+    """
+    def __init__(self, directory: str, force=()) -> None:
+        self.directory = directory
+        self.force = set(force)
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage: str, params: dict, inputs=()) -> str:
+        """Hash of the stage name, its parameters and the hashes of its inputs."""
+        description = json.dumps({'stage': stage, 'params': params, 'inputs': list(inputs)}, sort_keys=True,
+                                 default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def path(self, stage: str, key: str) -> str:
+        return os.path.join(self.directory, f'{stage}-{key[:16]}.pkl')
+
+    def run(self, stage: str, params: dict, inputs, compute):
+        """
+        Return the hash and the result of a stage. The 'inputs' argument is a list of
+        (hash, value) pairs of upstream results, and compute is called with their
+        values when the result is not stored yet (or the stage is forced).
+        """
+        key = self.key(stage, params, [input_key for input_key, _ in inputs])
+        path = self.path(stage, key)
+        if stage not in self.force and os.path.exists(path):
+            with open(path, 'rb') as fd:
+                result = pickle.load(fd)
+            print(f'[{stage}] loaded from {path}')
+            return key, result
+
+        start = time.perf_counter()
+        result = compute(*[value for _, value in inputs])
+        # write to a temporary file first, so an interrupted run leaves no broken results
+        with open(path + '.tmp', 'wb') as fd:
+            pickle.dump(result, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        print(f'[{stage}] computed in {time.perf_counter() - start:.1f} s, saved to {path}')
+        return key, result
+
+
+def load_values(args):
+    """Load stage: sensor values from the input file or from the DB."""
+    if args.input is not None:
+        if args.input.endswith('.parquet'):
+            return pd.read_parquet(args.input)
+        return pd.read_csv(args.input)
+
+    exploratory_analysis_src()
+    from dotenv import load_dotenv
+    from src.data.jems_data import DieselDs, VALUE_COLUMNS
+    load_dotenv()
+    dt = DieselDs(os.getenv("DB_PASSWORD"))
+    return dt.load_range(args.start_date, args.end_date, args.type, sensors=args.component, columns=VALUE_COLUMNS)
+
+
+def pivot_values(values, sensors=None):
+    """
+    Pivot stage: one column per sensor (named by its id) and millisecond timestamps
+    as index, only the given sensors if the list is not None.
+    """
+    if 'sensors_id' not in values.columns:
+        # already StreamStory input
+        table = values.set_index(values.columns[0])
+    else:
+        exploratory_analysis_src()
+        from src.data.pivot import pivot_sensor_values
+        table = pivot_sensor_values(values)
+        table.columns = table.columns.map(str)
+    if not pd.api.types.is_numeric_dtype(table.index):
+        table.index = pd.to_datetime(table.index).values.astype('datetime64[ms]').astype(np.int64)
+    table.index.name = 'timestamp'
+    return table if sensors is None else table.filter(sensors)
+
+
+def impute_values(table, grid_step, fill, max_gap):
+    """Impute stage: even grid (if grid_step is given), filled gaps and only complete rows."""
+    exploratory_analysis_src()
+    from src.data.resample import resample_sensor_values, fill_gaps
+    if grid_step is not None:
+        # float64 as without resampling, so the cluster stage gets the same precision either way
+        table, _ = resample_sensor_values(table, grid_step, fill, max_gap, dtype=np.float64)
+    else:
+        values = np.ascontiguousarray(table.to_numpy(dtype=np.float64, copy=True))
+        missing = np.isnan(values)
+        fill_gaps(values, method=fill, max_gap=max_gap)
+        check_filled(missing, np.isnan(values), max_gap)
+        table = pd.DataFrame(values, index=table.index, columns=table.columns)
+    return table.dropna()
+
+
+def check_filled(missing, still_missing, max_gap):
+    """
+    Raise RuntimeError if cells missing before the gap filling (mask 'missing') that
+    follow an observed value of their column are still missing (mask 'still_missing').
+    Such cells may only stay missing in gaps longer than max_gap.
+    """
+    if max_gap is not None:
+        return
+    after_observed = np.maximum.accumulate(~missing, axis=0)
+    unfilled = np.count_nonzero(still_missing & after_observed)
+    if unfilled:
+        raise RuntimeError(f"Gap filling left {unfilled} of {np.count_nonzero(missing)} missing values unfilled.")
+
+
+def cluster_values(table, n_clusters):
+    """Cluster stage: fitted StateGraph and data with column 'label'."""
+    graph = StateGraph(n_clusters=n_clusters)
+    labeled = graph.fit_transform(table)
+    return graph, labeled
+
+
+def fit_model(features, labeled, window_size):
+    """Model stage: TransitionModel fitted on the features, with history for further predictions."""
+    tm = TransitionModel(window_size)
+    tm.partial_fit_prepared(features)
+    tm.history = labeled.tail(window_size)
+    return tm
+
+
+def run_pipeline(args):
+    """Run all stages and return a dictionary with the result of each stage."""
+    # stages downstream of a forced stage are forced as well
+    force = STAGES[min(STAGES.index(stage) for stage in args.force):] if args.force else ()
+    cache = StageCache(args.cache_dir, force)
+    results = {}
+
+    if args.input is not None:
+        params = {'input': file_hash(args.input)}
+    else:
+        params = {'start_date': args.start_date, 'end_date': args.end_date, 'type': args.type,
+                  'component': args.component}
+    load = cache.run('load', params, [], lambda: load_values(args))
+    pivot = cache.run('pivot', {'sensors': args.sensors}, [load], lambda values: pivot_values(values, args.sensors))
+    # version 2: results of earlier versions could have unfilled gaps
+    impute = cache.run('impute', {'grid_step': args.grid_step, 'fill': args.fill, 'max_gap': args.max_gap,
+                                  'version': 2}, [pivot],
+                       lambda table: impute_values(table, args.grid_step, args.fill, args.max_gap))
+    cluster = cache.run('cluster', {'n_clusters': args.n_clusters}, [impute],
+                        lambda table: cluster_values(table, args.n_clusters))
+    transitions = cache.run('transitions', {}, [cluster], lambda clustered: clustered[0].transitions)
+    # labeled data under the hash of the cluster stage
+    labeled = (cluster[0], cluster[1][1])
+    features = cache.run('features', {'window_size': args.window_size}, [labeled],
+                         lambda data: TransitionModel(args.window_size).prepare_data(data, use_history=False))
+    model = cache.run('model', {'window_size': args.window_size}, [features, labeled],
+                      lambda data, labels: fit_model(data, labels, args.window_size))
+
+    for stage, (_, result) in zip(STAGES, [load, pivot, impute, cluster, transitions, features, model]):
+        results[stage] = result
+    return results
+
+
+if __name__ == "__main__":
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', default=None, help="[OPTIONAL] Csv or parquet with long sensor values (timestamp, sensors_id, value) or StreamStory input. If not given, values are loaded from the DB.")
+    parser.add_argument('-s', '--start-date', default="2017-01-21", help="Start of interval loaded from the DB. \
+                        Date must be given as 'YYYY-MM-DD hh:mm:ss' or as any prefix of it.", metavar='S')
+    parser.add_argument('-e', '--end-date', default="2017-01-22", help="End of interval loaded from the DB. \
+                        Date must be given as 'YYYY-MM-DD hh:mm:ss' or as any prefix of it.", metavar='E')
+    parser.add_argument('-t', '--type', default="hour", help="Type of DB values (raw, hour, day, ...).")
+    parser.add_argument('-c', '--component', default=None, help="[OPTIONAL] Load only sensors of this component.")
+    parser.add_argument('--sensors', nargs='+', default=None, help="[OPTIONAL] Use only these sensors (ids or column names).")
+    parser.add_argument('-gs', '--grid-step', default=None, type=int, help="[OPTIONAL] Resample values onto an even grid with this step (ms).")
+    parser.add_argument('--fill', default='linear', choices=('ffill', 'linear'), help="Method for filling the gaps.")
+    parser.add_argument('--max-gap', default=None, type=int, help="[OPTIONAL] Longest gap (in rows) that is filled.")
+    parser.add_argument('-k', '--n-clusters', default=5, type=int, help="Number of states.")
+    parser.add_argument('-w', '--window-size', default=5, type=int, help="Window size of the transition model.")
+    parser.add_argument('-cd', '--cache-dir', default='../data/pipeline', help="Directory for the results of stages.")
+    parser.add_argument('-f', '--force', nargs='+', default=[], choices=STAGES, help="[OPTIONAL] Recompute these stages and all stages downstream of them.")
+    parser.add_argument('-o', '--output-csv', default=None, help="[OPTIONAL] Path to output csv with labeled data.")
+    args = parser.parse_args()
+
+    results = run_pipeline(args)
+    if args.output_csv is not None:
+        results['cluster'][1].to_csv(args.output_csv)
+    print(results['transitions'].toarray())
+    print('Accuracy of the transition model:', results['model'].accuracy)
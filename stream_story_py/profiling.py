@@ -0,0 +1,197 @@
+"""
+Profiling - low overhead instrumentation of the hot paths of StreamStoryPy.
+
+Methods decorated with @profiled record per stage wall time, number of calls and
+rows processed (length of the first argument after self), and optionally
+allocated and peak memory (with tracemalloc). Recording is switched on
+    - for a whole run with the environment variable STREAMSTORY_PROFILE=1
+        (or =memory to also trace memory), results are written at exit to the
+        file in STREAMSTORY_PROFILE_OUTPUT (.json or .prom), if given
+    - for a block of code with the context manager `profiling()`
+When it is off, a decorated method costs one flag check per call.
+
+Example:
+    with profiling(memory=True) as profile:
+        graph.fit_transform(data)
+    print(profile.to_prometheus())
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+# environment variables that switch on profiling for a whole run
+PROFILE_ENV = "STREAMSTORY_PROFILE"
+PROFILE_OUTPUT_ENV = "STREAMSTORY_PROFILE_OUTPUT"
+
+
+class Profile(object):
+    """
+    Collected statistics per stage.
+
+    Attributes:
+        stages: dict mapping stage names to dicts with calls, seconds, rows,
+            allocated_bytes and peak_bytes.
+        memory: whether allocations and peak memory are traced.
+    """
+    def __init__(self, memory: bool = False) -> None:
+        self.memory = memory
+        self.stages = {}
+        self.lock = threading.Lock()
+        # highest memory seen so far in each of the enclosing profiled calls
+        self.peaks = []
+
+    def record(self, stage: str, seconds: float, rows: int, allocated: int = 0, peak: int = 0) -> None:
+        with self.lock:
+            stats = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'rows': 0,
+                                                   'allocated_bytes': 0, 'peak_bytes': 0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['rows'] += rows
+            stats['allocated_bytes'] += allocated
+            stats['peak_bytes'] = max(stats['peak_bytes'], peak)
+
+    def summary(self) -> dict:
+        """Statistics per stage with rows per second."""
+        with self.lock:
+            return {stage: dict(stats, rows_per_second=stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0)
+                    for stage, stats in self.stages.items()}
+
+    def to_json(self, path: str = None) -> str:
+        """Return the summary as JSON and write it to path if given."""
+        text = json.dumps(self.summary(), indent=2, sort_keys=True)
+        if path is not None:
+            with open(path, 'w') as fd:
+                fd.write(text)
+        return text
+
+    def to_prometheus(self, path: str = None) -> str:
+        """Return the summary in the Prometheus text exposition format and write it to path if given."""
+        metrics = [
+            ('calls', 'streamstory_stage_calls_total', 'counter', "Number of calls of the stage."),
+            ('seconds', 'streamstory_stage_seconds_total', 'counter', "Wall time spent in the stage."),
+            ('rows', 'streamstory_stage_rows_total', 'counter', "Rows processed by the stage."),
+            ('rows_per_second', 'streamstory_stage_rows_per_second', 'gauge', "Rows processed per second."),
+            ('allocated_bytes', 'streamstory_stage_allocated_bytes_total', 'counter',
+             "Memory allocated and not freed by the stage."),
+            ('peak_bytes', 'streamstory_stage_peak_bytes', 'gauge', "Highest additional memory used by a call."),
+        ]
+        summary = self.summary()
+        lines = []
+        for field, name, kind, help in metrics:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for stage, stats in sorted(summary.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {stats[field]}')
+        text = '\n'.join(lines) + '\n'
+        if path is not None:
+            with open(path, 'w') as fd:
+                fd.write(text)
+        return text
+
+    def export(self, path: str) -> None:
+        """Write the summary to path in Prometheus format for .prom files and JSON otherwise."""
+        if path.endswith('.prom'):
+            self.to_prometheus(path)
+        else:
+            self.to_json(path)
+
+
+# the active profile, None when profiling is off
+_profile = None
+
+
+def current_profile():
+    """Return the active Profile or None."""
+    return _profile
+
+
+@contextmanager
+def profiling(memory: bool = False):
+    """Record profiled calls inside the block and yield the Profile."""
+    global _profile
+    previous = _profile
+    _profile = Profile(memory)
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        yield _profile
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        _profile = previous
+
+
+def _rows(args) -> int:
+    """Number of rows of the first argument with a length (DataFrame, array, ...)."""
+    for arg in args:
+        if hasattr(arg, 'shape'):
+            return arg.shape[0] if len(arg.shape) else 0
+        if hasattr(arg, '__len__') and not isinstance(arg, str):
+            return len(arg)
+    return 0
+
+
+def profiled(stage: str):
+    """
+    Decorator recording calls of a method as the given stage of the active profile.
+    Rows are counted from the first argument after self.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _profile
+            if profile is None:
+                return func(*args, **kwargs)
+
+            # args[0] is self of the profiled method
+            rows = _rows(args[1:]) or _rows(kwargs.values())
+            if not (profile.memory and tracemalloc.is_tracing()):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profile.record(stage, time.perf_counter() - start, rows)
+
+            # tracemalloc has a single peak, so the peak of the enclosing call so far
+            # is kept on the stack before it is reset for this call
+            current, peak = tracemalloc.get_traced_memory()
+            if profile.peaks:
+                profile.peaks[-1] = max(profile.peaks[-1], peak)
+            profile.peaks.append(0)
+            tracemalloc.reset_peak()
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                after, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, profile.peaks.pop())
+                profile.record(stage, seconds, rows, after - current, peak - current)
+                if profile.peaks:
+                    profile.peaks[-1] = max(profile.peaks[-1], peak)
+        return wrapper
+    return decorator
+
+
+def _profile_from_environment():
+    """Switch on profiling for the whole run if requested by the environment."""
+    global _profile
+    setting = os.environ.get(PROFILE_ENV, "").lower()
+    if setting in ("", "0", "false", "no"):
+        return
+    _profile = Profile(memory=setting == "memory")
+    if _profile.memory:
+        tracemalloc.start()
+    output = os.environ.get(PROFILE_OUTPUT_ENV)
+    if output:
+        atexit.register(_profile.export, output)
+
+
+_profile_from_environment()
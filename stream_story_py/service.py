@@ -0,0 +1,277 @@
+"""
+Service - real-time state labeling and next-state prediction with asyncio.
+
+Readings (timestamp and values of the sensors of a fitted StateGraph) come from a
+source and go through a bounded queue, so a source that is faster than the
+processing waits (backpressure) instead of filling memory. Readings are taken
+from the queue in micro-batches (up to batch_size readings or max_delay seconds),
+and each batch is
+    - labeled with StateGraph.predict,
+    - added to the counts of transitions between states,
+    - passed to TransitionModel.predict for the next state of every reading.
+End-to-end latency (from arrival of a reading to its prediction) and throughput
+are measured and reported.
+
+Sources:
+    - FileReplaySource: replays a csv/parquet with StreamStory input, optionally
+        at a fixed rate
+    - SocketSource: TCP stand-in, a client sends lines 'timestamp,value1,value2,...'
+
+Graph and model are pickles, e.g. the results of the cluster and model stages of
+pipeline.py. With a refit window, the graph is wrapped in an AdaptiveStateGraph
+that is refitted in the background when the data drifts (see drift.py).
+"""
+
+import time
+import pickle
+import asyncio
+import argparse
+from collections import deque
+import numpy as np
+import pandas as pd
+
+from state_graph import StateGraph, count_transitions, normalize_rows
+from transition_model import TransitionModel
+from drift import DriftMonitor, AdaptiveStateGraph
+
+
+class FileReplaySource(object):
+    """Replays readings from a file with timestamp in the first column and one column per sensor."""
+    def __init__(self, path: str, columns, rate: float = None) -> None:
+        """
+        Arguments:
+            path -- csv or parquet with StreamStory input.
+            columns -- sensor columns in the order expected by the graph.
+            rate -- readings per second, as fast as possible if None.
+        """
+        data = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+        data = data.set_index(data.columns[0])
+        self.timestamps = data.index.to_numpy()
+        self.values = data[list(columns)].to_numpy(dtype=np.float64)
+        self.rate = rate
+
+    async def readings(self):
+        start = time.perf_counter()
+        for i in range(len(self.values)):
+            if self.rate is not None:
+                delay = start + i / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield self.timestamps[i], self.values[i]
+
+
+class SocketSource(object):
+    """Accepts one TCP client that sends readings as csv lines, until it disconnects."""
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765) -> None:
+        self.host = host
+        self.port = port
+
+    async def readings(self):
+        connections = asyncio.Queue()
+        server = await asyncio.start_server(lambda reader, writer: connections.put_nowait((reader, writer)),
+                                            self.host, self.port)
+        print(f'Waiting for readings on {self.host}:{self.port}')
+        async with server:
+            reader, writer = await connections.get()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                fields = line.decode().strip().split(',')
+                if len(fields) > 1:
+                    yield int(fields[0]), np.array(fields[1:], dtype=np.float64)
+            writer.close()
+
+
+class StreamService(object):
+    """
+    Labels readings with a StateGraph and predicts next states with a TransitionModel.
+
+    Attributes:
+        transition_counts: sparse CSR matrix of shape (n_clusters, n_clusters) with counts of observed transitions.
+        readings: number of processed readings.
+        batches: number of processed batches.
+        latencies: end-to-end latencies (s) of the most recent readings.
+    """
+    def __init__(self, graph: StateGraph, model: TransitionModel = None, batch_size: int = 256,
+                 max_delay: float = 0.05, queue_size: int = 10000, on_batch=None) -> None:
+        """
+        Arguments:
+            graph -- fitted StateGraph (or AdaptiveStateGraph), readings have values of its centroid columns.
+            model -- fitted TransitionModel or None for labeling only.
+            batch_size -- maximal number of readings processed at once.
+            max_delay -- maximal time (s) a reading waits for its batch to fill.
+            queue_size -- maximal number of readings waiting in the queue.
+            on_batch -- called with each processed batch, a DataFrame with sensor
+                values, 'label' and 'next_state'.
+        """
+        self.graph = graph
+        self.model = model
+        self.columns = graph.centroids.columns
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self.on_batch = on_batch
+
+        self.transition_counts = count_transitions([], graph.n_clusters)
+        self.previous_label = -1
+        self.readings = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=100000)
+        self.start = None
+
+    async def ingest(self, source, queue: asyncio.Queue) -> None:
+        """Put readings of the source with their arrival time to the queue, waits while it is full."""
+        async for timestamp, values in source.readings():
+            await queue.put((time.perf_counter(), timestamp, values))
+        await queue.put(None)
+
+    async def next_batch(self, queue: asyncio.Queue):
+        """Return a list of up to batch_size readings and whether the source has ended."""
+        item = await queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.batch_size:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def process(self, batch) -> pd.DataFrame:
+        """Label a batch, count its transitions and predict next states."""
+        arrivals = np.array([arrival for arrival, _, _ in batch])
+        data = pd.DataFrame(np.vstack([values for _, _, values in batch]),
+                            index=pd.Index([timestamp for _, timestamp, _ in batch], name='timestamp'),
+                            columns=self.columns)
+        labels = self.graph.predict(data)
+
+        # transitions between consecutive different states, including the one from the previous batch
+        sequence = np.concatenate([[self.previous_label], labels]) if self.previous_label >= 0 else labels
+        self.transition_counts += count_transitions(sequence, self.graph.n_clusters)
+        self.previous_label = labels[-1]
+
+        data['label'] = labels
+        next_state = np.full(len(data), -1)
+        if self.model is not None:
+            # with history the model predicts for the last history row as well,
+            # readings without a full window get no prediction
+            predictions = np.asarray(self.model.predict(data))[-len(data):]
+            next_state[len(data) - len(predictions):] = predictions
+        data['next_state'] = next_state
+
+        self.latencies.extend(time.perf_counter() - arrivals)
+        self.readings += len(batch)
+        self.batches += 1
+        return data
+
+    def transitions(self):
+        """Observed transition probabilities as sparse CSR matrix (rows without transitions are zero)."""
+        return normalize_rows(self.transition_counts)
+
+    def metrics(self) -> dict:
+        """Throughput, end-to-end latency percentiles and drift statistics of an AdaptiveStateGraph."""
+        elapsed = time.perf_counter() - self.start if self.start is not None else 0.0
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        p50, p95, p99 = (float(p) for p in np.percentile(latencies, [50, 95, 99]) * 1000)
+        metrics = {'readings': self.readings, 'batches': self.batches,
+                   'readings_per_second': self.readings / elapsed if elapsed > 0 else 0.0,
+                   'latency_ms_p50': p50, 'latency_ms_p95': p95, 'latency_ms_p99': p99,
+                   'latency_ms_max': float(latencies.max()) * 1000}
+        if isinstance(self.graph, AdaptiveStateGraph):
+            metrics.update(self.graph.monitor.statistics(), refits=self.graph.refits,
+                           failed_refits=self.graph.failed_refits)
+        return metrics
+
+    async def report(self, interval: float) -> None:
+        """Print metrics every interval seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            metrics = self.metrics()
+            print(f"{metrics['readings']} readings, {metrics['readings_per_second']:.0f} readings/s, "
+                  f"latency p50 {metrics['latency_ms_p50']:.1f} ms, p99 {metrics['latency_ms_p99']:.1f} ms")
+
+    async def run(self, source, report_interval: float = None) -> dict:
+        """Process all readings of the source and return the final metrics."""
+        self.start = time.perf_counter()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        producer = asyncio.create_task(self.ingest(source, queue))
+        reporter = asyncio.create_task(self.report(report_interval)) if report_interval else None
+        try:
+            done = False
+            while not done:
+                batch, done = await self.next_batch(queue)
+                if batch:
+                    data = self.process(batch)
+                    if self.on_batch is not None:
+                        self.on_batch(data)
+            await producer
+        finally:
+            producer.cancel()
+            if reporter is not None:
+                reporter.cancel()
+        return self.metrics()
+
+
+def load_pickle(path: str, first: bool = True):
+    """Load a pickled object, for results of pipeline stages with several values take the first one if first."""
+    with open(path, 'rb') as fd:
+        result = pickle.load(fd)
+    return result[0] if first and isinstance(result, tuple) else result
+
+
+if __name__ == "__main__":
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-g', '--graph', help="Path to pickled StateGraph (or result of the cluster stage of pipeline.py).")
+    parser.add_argument('-m', '--model', default=None, help="[OPTIONAL] Path to pickled TransitionModel for next-state predictions.")
+    parser.add_argument('-i', '--input', default=None, help="[OPTIONAL] Csv or parquet with StreamStory input to replay. If not given, readings are received on a socket.")
+    parser.add_argument('-r', '--rate', default=None, type=float, help="[OPTIONAL] Replay rate in readings per second, as fast as possible if not given.")
+    parser.add_argument('--host', default='127.0.0.1', help="Host of the socket source.")
+    parser.add_argument('--port', default=8765, type=int, help="Port of the socket source.")
+    parser.add_argument('-b', '--batch-size', default=256, type=int, help="Maximal number of readings in a micro-batch.")
+    parser.add_argument('-d', '--max-delay', default=0.05, type=float, help="Maximal time (s) a reading waits for its micro-batch.")
+    parser.add_argument('-q', '--queue-size', default=10000, type=int, help="Maximal number of readings waiting in the queue.")
+    parser.add_argument('-o', '--output-csv', default=None, help="[OPTIONAL] Path to output csv with labels and next states.")
+    parser.add_argument('-rw', '--refit-window', default=None, type=int, help="[OPTIONAL] Refit the graph on this many most recent readings when the data drifts. Needs the result of the cluster stage as graph.")
+    parser.add_argument('-dw', '--drift-window', default=1000, type=int, help="Number of most recent readings drift is measured on.")
+    parser.add_argument('--distance-threshold', default=1.5, type=float, help="Drift when mean distance to the nearest centroid grows by this factor.")
+    parser.add_argument('--label-threshold', default=0.3, type=float, help="Drift when the distribution of states changes by this total variation distance.")
+    args = parser.parse_args()
+
+    graph = load_pickle(args.graph, first=args.refit_window is None)
+    if args.refit_window is not None:
+        if not isinstance(graph, tuple):
+            raise RuntimeError("Refitting needs the result of the cluster stage of pipeline.py (graph and its data).")
+        graph, labeled = graph
+        monitor = DriftMonitor(graph.n_clusters, args.drift_window, args.distance_threshold, args.label_threshold)
+        graph = AdaptiveStateGraph(graph, labeled.drop(columns='label'), args.refit_window, monitor)
+    model = load_pickle(args.model) if args.model is not None else None
+    if args.input is not None:
+        source = FileReplaySource(args.input, graph.centroids.columns, args.rate)
+    else:
+        source = SocketSource(args.host, args.port)
+
+    output = open(args.output_csv, 'w', newline='') if args.output_csv is not None else None
+    on_batch = (lambda data: data.to_csv(output, header=output.tell() == 0)) if output is not None else None
+    service = StreamService(graph, model, args.batch_size, args.max_delay, args.queue_size, on_batch)
+    try:
+        metrics = asyncio.run(service.run(source, report_interval=5))
+    finally:
+        if output is not None:
+            output.close()
+        if isinstance(graph, AdaptiveStateGraph):
+            graph.close()
+    print(metrics)
+    print(service.transitions().toarray())
@@ -25,11 +25,13 @@ State transition model
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
 
 from sklearn.cluster import KMeans
 from sklearn import preprocessing
 
 from transition_model import TransitionModel
+from profiling import profiled
 
 
 class StateGraph(object):
@@ -40,8 +42,9 @@ class StateGraph(object):
 
     Attributes:
         centroids: DataFrame of shape (n_centroids, n_features): Coordinates of centroids.
-        transitions: ndarray of shape (n_clusters, n_clusters): Distribution of transitions where number in row i and
-            column j represents transition from state i to state j. Numbers on diagonal are 0.
+        transitions: sparse CSR matrix of shape (n_clusters, n_clusters): Distribution of transitions where number in
+            row i and column j represents transition from state i to state j. Numbers on diagonal are 0, rows of states
+            without outgoing transitions are 0.
         transition_model: TransitionModel that can predict next state.
     """
     # TODO: Should also support inspection and visualisation for convenience
@@ -59,11 +62,14 @@ class StateGraph(object):
 
         # DataFrame where each row is coordinate of a centroid
         self.centroids = None
-        # Matrix of transitions with values between 0 and 1
+        # Sparse matrix of transitions with values between 0 and 1
         self.transitions = None
         # Model that can predict next state. Must be initialized manually.
         self.transition_model = None
+        # DriftMonitor updated with distances and labels of transformed data. Must be initialized manually.
+        self.monitor = None
 
+    @profiled("StateGraph.fit")
     def fit(self, data: pd.DataFrame) -> None:
         """Fit to data. Expect Pandas DataFrame as input with timestamp as index."""
         norm_data = pd.DataFrame(data=self.normalisation.fit_transform(data),
@@ -74,32 +80,86 @@ class StateGraph(object):
 
         self.centroids = pd.DataFrame(data=self.normalisation.inverse_transform(self.clustering.cluster_centers_),
                                       columns=norm_data.columns)
+        if getattr(self, 'monitor', None) is not None:
+            self.monitor.set_reference(*self.nearest(data))
 
+    def nearest(self, data: pd.DataFrame):
+        """ Return index of the closest cluster for each sample and the distance to it (in normalised space). """
+        norm_data = pd.DataFrame(data=self.normalisation.transform(data), index=data.index, columns=data.columns)
+        distances = self.clustering.transform(norm_data)
+        labels = np.argmin(distances, axis=1)
+        return labels, distances[np.arange(len(labels)), labels]
+
+    @profiled("StateGraph.transform")
     def transform(self, data: pd.DataFrame) -> pd.DataFrame:
         """ Expect Pandas DataFrame as input with timestamp as index.
             Returns data with column `label` which has index of the closest cluster for each sample. """
-        norm_data = pd.DataFrame(data=self.normalisation.transform(data),
-                                 index=data.index,
-                                 columns=data.columns)
-
-        labels = pd.DataFrame(self.clustering.predict(norm_data), index=norm_data.index, columns=['label'])
+        labels = pd.DataFrame(self.predict(data), index=data.index, columns=['label'])
 
         # Calculate transitions between states
-        self.transitions = np.zeros([self.n_clusters, self.n_clusters])
-        prev = -1
-        for index, row in labels.iterrows():
-            if index > 0 and prev != row['label']:
-                self.transitions[prev, row['label']] += 1
-            prev = row['label']
-        self.transitions = np.apply_along_axis(lambda row : row / row.sum(), 1, self.transitions)
+        self.transitions = normalize_rows(count_transitions(labels['label'].to_numpy(), self.n_clusters))
 
         return pd.concat([data, labels], axis=1)
 
+    @profiled("StateGraph.predict")
+    def predict(self, data: pd.DataFrame) -> np.ndarray:
+        """ Return index of the closest cluster for each sample, without updating transitions. """
+        labels, distances = self.nearest(data)
+        # monitor is missing in graphs pickled before it was added
+        if getattr(self, 'monitor', None) is not None:
+            self.monitor.update(labels, distances)
+        return labels
+
     def fit_transform(self, data: pd.DataFrame) -> pd.DataFrame:
         """ Expect Pandas DataFrame as input with timestamp as index. """
         self.fit(data)
         return self.transform(data)
 
+    def top_edges(self, k: int = 5, min_probability: float = 0.0) -> pd.DataFrame:
+        """ Return the k most probable transitions of each state with at least min_probability, as DataFrame with
+            columns source, target and probability. """
+        return top_k_edges(self.transitions, k, min_probability)
+
+    def export_graph(self, path: str, k: int = 5, min_probability: float = 0.0) -> None:
+        """ Save the top k transitions of each state as an edge list (.csv) or as a sparse matrix (.npz). """
+        edges = self.top_edges(k, min_probability)
+        if path.endswith('.npz'):
+            sparse.save_npz(path, sparse.csr_matrix((edges['probability'], (edges['source'], edges['target'])),
+                                                    shape=self.transitions.shape))
+        else:
+            edges.to_csv(path, index=False)
+
+
+def count_transitions(labels: np.ndarray, n_states: int) -> sparse.csr_matrix:
+    """ Return sparse matrix with number of transitions from state i to a different state j in the label sequence. """
+    labels = np.asarray(labels, dtype=np.int64)
+    changed = labels[1:] != labels[:-1]
+    ones = np.ones(np.count_nonzero(changed), dtype=np.int64)
+    # duplicate entries are summed by the conversion to CSR
+    return sparse.coo_matrix((ones, (labels[:-1][changed], labels[1:][changed])),
+                             shape=(n_states, n_states)).tocsr()
+
+
+def normalize_rows(matrix: sparse.spmatrix) -> sparse.csr_matrix:
+    """ Divide each row of the sparse matrix by its sum, rows that sum to 0 stay 0. """
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.divide(1.0, sums, out=np.zeros_like(sums), where=sums != 0)
+    return sparse.diags(scale).dot(matrix).tocsr()
+
+
+def top_k_edges(matrix: sparse.spmatrix, k: int, min_probability: float = 0.0) -> pd.DataFrame:
+    """ Return the k largest entries of each row of the sparse matrix with value at least min_probability, as
+        DataFrame with columns source, target and probability (sorted by source and decreasing probability). """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.eliminate_zeros()
+    sources = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    # order entries by row and decreasing value, rank is the position within the row
+    order = np.lexsort((-matrix.data, sources))
+    rank = np.arange(len(order)) - matrix.indptr[sources[order]]
+    keep = order[(rank < k) & (matrix.data[order] >= min_probability)]
+    return pd.DataFrame({'source': sources[keep], 'target': matrix.indices[keep], 'probability': matrix.data[keep]})
+
 
 if __name__ == "__main__":
     sensor_list = ["50", "53", "55", "62", "63", "64", "65", "97", "98"]
@@ -109,4 +169,4 @@ if __name__ == "__main__":
     result = graph.fit_transform(values)
     result.to_csv('../data/stateGraphOutput.csv')
     print(result)
-    print(graph.transitions)
+    print(graph.transitions.toarray())
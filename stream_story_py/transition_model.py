@@ -1,8 +1,10 @@
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from skmultiflow.trees import HoeffdingTreeClassifier
 from skmultiflow.data import DataStream
 from typing import List
+from profiling import profiled
 
 
 class TransitionModel:
@@ -35,9 +37,15 @@ class TransitionModel:
         x = np.arange(len(y))
         return np.polyfit(x, y, 1)[0]
 
+    def delta_weights(self) -> np.ndarray:
+        """ Weights of the values in a window that give the slope of least squares linear fit (see delta). """
+        x = np.arange(self.window_size) - (self.window_size - 1) / 2
+        return x / (x ** 2).sum()
+
     def check_data(self):
         pass
 
+    @profiled("TransitionModel.prepare_data")
     def prepare_data(self, data: pd.DataFrame, drop_last_row: bool = True, use_history: bool = True) -> pd.DataFrame:
         """ Take raw data and return data stream with running average and running delta. For the last row there is no
             next state, so drop_last_row should be True for learning, but False for predicting. If use_history is set
@@ -50,10 +58,21 @@ class TransitionModel:
         sensor_values = data.drop(columns='label')
         labels = data['label']
 
-        prepared_data = pd.DataFrame()
-        for col in sensor_values.columns:
-            prepared_data[col+'_mean'] = sensor_values[col].rolling(window=self.window_size).mean()
-            prepared_data[col+'_delta'] = sensor_values[col].rolling(window=self.window_size).apply(self.delta, raw=True)
+        # running average and delta of all sensors at once, delta is the least squares slope,
+        # which is a fixed linear combination of the values in the window
+        values = sensor_values.to_numpy(dtype=np.float64)
+        means = np.full(values.shape, np.nan)
+        deltas = np.full(values.shape, np.nan)
+        if len(values) >= self.window_size:
+            windows = sliding_window_view(values, self.window_size, axis=0)
+            means[self.window_size-1:] = windows.mean(axis=2)
+            deltas[self.window_size-1:] = windows @ self.delta_weights()
+
+        features = {}
+        for i, col in enumerate(sensor_values.columns):
+            features[col+'_mean'] = means[:, i]
+            features[col+'_delta'] = deltas[:, i]
+        prepared_data = pd.DataFrame(features, index=data.index)
         prepared_data['current_state'] = labels
         prepared_data['next_state'] = labels.shift(periods=-1, fill_value=-1)
 
@@ -63,10 +82,16 @@ class TransitionModel:
         prepared_data.drop(prepared_data.head(self.window_size-1).index, inplace=True)
         return prepared_data
 
+    @profiled("TransitionModel.partial_fit")
     def partial_fit(self, data: pd.DataFrame) -> None:
         """ The most basic working version for now.
         TODO: improve, calculate accuracy, maybe add possibility to learn in batches? """
-        stream = DataStream(self.prepare_data(data))
+        self.partial_fit_prepared(self.prepare_data(data))
+
+    @profiled("TransitionModel.partial_fit_prepared")
+    def partial_fit_prepared(self, prepared_data: pd.DataFrame) -> None:
+        """ Fit on data already returned by prepare_data (e.g. computed once and stored). """
+        stream = DataStream(prepared_data)
         n = stream.n_remaining_samples()
         for i in range(n):
             x, y = stream.next_sample()
@@ -76,6 +101,7 @@ class TransitionModel:
         self.predictions += n
         self.accuracy = self.correct_predictions / self.predictions
 
+    @profiled("TransitionModel.predict")
     def predict(self, data: pd.DataFrame = pd.DataFrame(), use_history: bool = True) -> List[int]:
         """ Argument data is a DataFrame with shape (n_samples, n_features).
         use_history tells whether or not history will be included in data before making prediction. If use_history is